@@ -0,0 +1,416 @@
+import array
+import collections.abc
+
+from rbtree import BLACK, RED
+
+NIL = -1
+
+
+class ArrayNode:
+    """
+    A handle to a node of an ArrayRBTree.
+    Handles are created on demand and only hold the tree and a slot index
+    """
+
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def key(self):
+        return self.tree._keys[self.index]
+
+    @property
+    def color(self):
+        return self.tree._colors[self.index]
+
+    @property
+    def left(self):
+        return self.tree._node(self.tree._left[self.index])
+
+    @property
+    def right(self):
+        return self.tree._node(self.tree._right[self.index])
+
+    @property
+    def parent(self):
+        return self.tree._node(self.tree._parent[self.index])
+
+    def __eq__(self, other):
+        return isinstance(other, ArrayNode) and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+
+class ArrayRBTree:
+    """
+    A Red-Black-Tree with the same public API as rbtree.RBTree, stored as
+    a struct of typed arrays: keys, colors and left/right/parent slot indices.
+    Deleted slots are chained into a free list through the left array and reused.
+    The arrays hold no Python objects, so the cyclic GC never has to scan the tree
+    """
+
+    def __init__(self, *args):
+        self._keys = array.array('q')
+        self._colors = array.array('b')
+        self._left = array.array('q')
+        self._right = array.array('q')
+        self._parent = array.array('q')
+        self._root = NIL
+        self._free = NIL
+
+        if len(args) == 1:
+            if isinstance(args[0], collections.abc.Iterable):
+                for x in args[0]:
+                    self.insert(x)
+            else:
+                raise TypeError(str(args[0]) + " is not iterable")
+
+    @property
+    def root(self):
+        return self._node(self._root)
+
+    def _node(self, index):
+        return None if index == NIL else ArrayNode(self, index)
+
+    def _find(self, key):
+        keys = self._keys
+        left = self._left
+        right = self._right
+        node = self._root
+        while node != NIL:
+            node_key = keys[node]
+            if key > node_key:
+                node = right[node]
+            elif key < node_key:
+                node = left[node]
+            else:
+                return node
+        return NIL
+
+    def get_node(self, key, start=None):
+        """Returns a node by key. Second optional param is a node to start searching from"""
+
+        if start is None:
+            return self._node(self._find(key))
+
+        keys = self._keys
+        node = start.index
+        while node != NIL:
+            if key > keys[node]:
+                node = self._right[node]
+            elif key < keys[node]:
+                node = self._left[node]
+            else:
+                return ArrayNode(self, node)
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) != NIL
+
+    def get(self, key, default=None):
+        """Returns a node by key or default if there is no such key"""
+
+        node = self._find(key)
+        return default if node == NIL else ArrayNode(self, node)
+
+    def get_path(self, node):
+        """Returns a path-list of keys from root to taken node"""
+
+        keys = self._keys
+        parent = self._parent
+        curr = node.index
+        lst = [keys[curr]]
+        while parent[curr] != NIL:
+            curr = parent[curr]
+            lst.append(keys[curr])
+
+        return reversed(lst)
+
+    def get_min(self, *args):
+        node = args[0].index if args else self._root
+        if node == NIL:
+            return None
+        left = self._left
+        while left[node] != NIL:
+            node = left[node]
+        return ArrayNode(self, node)
+
+    def get_max(self, *args):
+        node = args[0].index if args else self._root
+        if node == NIL:
+            return None
+        right = self._right
+        while right[node] != NIL:
+            node = right[node]
+        return ArrayNode(self, node)
+
+    def get_height(self, *args):
+        node = (args[0].index if args[0] else NIL) if args else self._root
+        if node == NIL:
+            return 0
+
+        height = -1
+        level = [node]
+        left = self._left
+        right = self._right
+        while level:
+            height += 1
+            level = [child for n in level for child in (left[n], right[n]) if child != NIL]
+        return height
+
+    def _alloc(self, key):
+        index = self._free
+        if index == NIL:
+            self._keys.append(key)
+            index = len(self._keys) - 1
+            self._colors.append(RED)
+            self._left.append(NIL)
+            self._right.append(NIL)
+            self._parent.append(NIL)
+        else:
+            self._keys[index] = key
+            self._free = self._left[index]
+            self._colors[index] = RED
+            self._left[index] = NIL
+            self._right[index] = NIL
+            self._parent[index] = NIL
+        return index
+
+    def _release(self, index):
+        self._left[index] = self._free
+        self._free = index
+
+    def insert(self, key):
+        """Insert a node with key. Returns True if the key was not in the tree yet"""
+
+        if not isinstance(key, int):
+            raise TypeError(str(key) + " is not an int")
+
+        keys = self._keys
+        left = self._left
+        right = self._right
+
+        parent = NIL
+        node = self._root
+        while node != NIL:
+            parent = node
+            if key > keys[node]:
+                node = right[node]
+            elif key < keys[node]:
+                node = left[node]
+            else:
+                return False
+
+        child = self._alloc(key)
+        self._parent[child] = parent
+        if parent == NIL:
+            self._root = child
+        elif key > keys[parent]:
+            right[parent] = child
+        else:
+            left[parent] = child
+
+        self._insert_fixup(child)
+        return True
+
+    def _insert_fixup(self, child):
+        colors = self._colors
+        left = self._left
+        right = self._right
+        parents = self._parent
+
+        while child != self._root and colors[parents[child]] == RED:
+            parent = parents[child]
+            grand_node = parents[parent]
+            if parent == left[grand_node]:
+                uncle = right[grand_node]
+                if uncle != NIL and colors[uncle] == RED:
+                    colors[parent] = BLACK
+                    colors[uncle] = BLACK
+                    colors[grand_node] = RED
+                    child = grand_node
+                else:
+                    if child == right[parent]:
+                        child = parent
+                        self._rotate_left(child)
+                        parent = parents[child]
+                    colors[parent] = BLACK
+                    colors[grand_node] = RED
+                    self._rotate_right(grand_node)
+            else:
+                uncle = left[grand_node]
+                if uncle != NIL and colors[uncle] == RED:
+                    colors[parent] = BLACK
+                    colors[uncle] = BLACK
+                    colors[grand_node] = RED
+                    child = grand_node
+                else:
+                    if child == left[parent]:
+                        child = parent
+                        self._rotate_right(child)
+                        parent = parents[child]
+                    colors[parent] = BLACK
+                    colors[grand_node] = RED
+                    self._rotate_left(grand_node)
+
+        colors[self._root] = BLACK
+
+    def _rotate_left(self, pivot):
+        left = self._left
+        right = self._right
+        parents = self._parent
+
+        new_root = right[pivot]
+        right[pivot] = left[new_root]
+        if left[new_root] != NIL:
+            parents[left[new_root]] = pivot
+
+        parent = parents[pivot]
+        parents[new_root] = parent
+        if parent == NIL:
+            self._root = new_root
+        elif pivot == left[parent]:
+            left[parent] = new_root
+        else:
+            right[parent] = new_root
+
+        left[new_root] = pivot
+        parents[pivot] = new_root
+
+    def _rotate_right(self, pivot):
+        left = self._left
+        right = self._right
+        parents = self._parent
+
+        new_root = left[pivot]
+        left[pivot] = right[new_root]
+        if right[new_root] != NIL:
+            parents[right[new_root]] = pivot
+
+        parent = parents[pivot]
+        parents[new_root] = parent
+        if parent == NIL:
+            self._root = new_root
+        elif pivot == right[parent]:
+            right[parent] = new_root
+        else:
+            left[parent] = new_root
+
+        right[new_root] = pivot
+        parents[pivot] = new_root
+
+    def _transplant(self, old, new):
+        parent = self._parent[old]
+        if parent == NIL:
+            self._root = new
+        elif old == self._left[parent]:
+            self._left[parent] = new
+        else:
+            self._right[parent] = new
+        if new != NIL:
+            self._parent[new] = parent
+
+    def delete(self, key):
+        """Deletes a node by key. Returns True if the key was in the tree"""
+
+        node = self._find(key)
+        if node == NIL:
+            return False
+
+        colors = self._colors
+        left = self._left
+        right = self._right
+        parents = self._parent
+
+        removed_color = colors[node]
+        if left[node] == NIL:
+            child = right[node]
+            child_parent = parents[node]
+            self._transplant(node, child)
+        elif right[node] == NIL:
+            child = left[node]
+            child_parent = parents[node]
+            self._transplant(node, child)
+        else:
+            successor = right[node]
+            while left[successor] != NIL:
+                successor = left[successor]
+            removed_color = colors[successor]
+            child = right[successor]
+            if parents[successor] == node:
+                child_parent = successor
+            else:
+                child_parent = parents[successor]
+                self._transplant(successor, child)
+                right[successor] = right[node]
+                parents[right[successor]] = successor
+            self._transplant(node, successor)
+            left[successor] = left[node]
+            parents[left[successor]] = successor
+            colors[successor] = colors[node]
+
+        if removed_color == BLACK:
+            self._delete_fixup(child, child_parent)
+        self._release(node)
+        return True
+
+    def _is_black(self, node):
+        return node == NIL or self._colors[node] == BLACK
+
+    def _delete_fixup(self, child, parent):
+        colors = self._colors
+        left = self._left
+        right = self._right
+
+        while child != self._root and self._is_black(child):
+            if child == left[parent]:
+                sibling = right[parent]
+                if colors[sibling] == RED:
+                    colors[sibling] = BLACK
+                    colors[parent] = RED
+                    self._rotate_left(parent)
+                    sibling = right[parent]
+                if self._is_black(left[sibling]) and self._is_black(right[sibling]):
+                    colors[sibling] = RED
+                    child = parent
+                    parent = self._parent[child]
+                else:
+                    if self._is_black(right[sibling]):
+                        colors[left[sibling]] = BLACK
+                        colors[sibling] = RED
+                        self._rotate_right(sibling)
+                        sibling = right[parent]
+                    colors[sibling] = colors[parent]
+                    colors[parent] = BLACK
+                    colors[right[sibling]] = BLACK
+                    self._rotate_left(parent)
+                    child = self._root
+            else:
+                sibling = left[parent]
+                if colors[sibling] == RED:
+                    colors[sibling] = BLACK
+                    colors[parent] = RED
+                    self._rotate_right(parent)
+                    sibling = left[parent]
+                if self._is_black(left[sibling]) and self._is_black(right[sibling]):
+                    colors[sibling] = RED
+                    child = parent
+                    parent = self._parent[child]
+                else:
+                    if self._is_black(left[sibling]):
+                        colors[right[sibling]] = BLACK
+                        colors[sibling] = RED
+                        self._rotate_left(sibling)
+                        sibling = left[parent]
+                    colors[sibling] = colors[parent]
+                    colors[parent] = BLACK
+                    colors[left[sibling]] = BLACK
+                    self._rotate_right(parent)
+                    child = self._root
+
+        if child != NIL:
+            colors[child] = BLACK
@@ -0,0 +1,299 @@
+"""
+Benchmarks for RBTree.
+
+    python bench.py suite [--sizes 1000,100000] [--distributions random,sorted]
+                          [--ops insert,get_node] [--output results.json]
+                          [--baseline old.json] [--threshold 0.1] [--repeat 5] [--noise-floor 0.01]
+    python bench.py scaling [size]
+
+suite times every operation for every size and key distribution with a fixed seed,
+keeping the best of --repeat runs, and writes the results as JSON. With --baseline it
+compares them to a stored run and exits with status 1 if any operation got slower by more
+than the threshold. Operations faster than --noise-floor seconds in both runs are not judged.
+scaling checks traversal stack depth and the delete rate
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import time
+
+import snapshot
+from rbtree import RBTree
+
+# low enough that any traversal recursing per tree level would fail
+STACK_GUARD = 50
+
+
+def _timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print('%-32s %10.3f sec' % (label, time.perf_counter() - start))
+    return result
+
+
+def bench_traversals(size):
+    """Runs every traversal and a pickle round trip on a tree of size keys in constant stack depth"""
+
+    tree = _timed('bulk_load(%d)' % size, RBTree.bulk_load, range(size))
+    try:
+        import main
+        drawer = main.TreeDrawer.__new__(main.TreeDrawer)
+    except ImportError:
+        drawer = None
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(STACK_GUARD)
+    try:
+        _timed('get_height', tree.get_height)
+        _timed('get_min + get_max', lambda: (tree.get_min(), tree.get_max()))
+        _timed('iterate', lambda: sum(1 for _ in tree))
+        data = _timed('pickle.dumps', pickle.dumps, tree, pickle.HIGHEST_PROTOCOL)
+        restored = _timed('pickle.loads', pickle.loads, data)
+        if drawer:
+            _timed('TreeDrawer._layout', drawer._layout, tree)
+    finally:
+        sys.setrecursionlimit(limit)
+
+    assert len(restored) == size
+
+
+def bench_delete(sizes, batch=20000):
+    """Deletes batch random keys from trees of growing size: the rate should stay flat"""
+
+    for size in sizes:
+        tree = RBTree.bulk_load(range(size))
+        keys = random.sample(range(size), min(batch, size // 2))
+        start = time.perf_counter()
+        for key in keys:
+            tree.delete(key)
+        elapsed = time.perf_counter() - start
+        tree.validate()
+        print('delete, %9d keys %12.0f ops/sec' % (size, len(keys) / elapsed))
+
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+DISTRIBUTIONS = ['random', 'sorted', 'reverse', 'clustered']
+OPS = ['insert', 'get_node', 'get_path', 'delete', 'bulk_load', 'export', 'import', 'plot']
+# lookups and deletes are timed on a sample of at most this many keys
+SAMPLE = 100000
+PLOT_SIZES = {10 ** 3, 10 ** 4, 10 ** 5}
+CLUSTER = 1000
+REPEAT = 5
+# seconds, compare ignores results faster than this
+NOISE_FLOOR = 0.01
+
+
+def make_keys(distribution, size, rng):
+    """Returns size distinct keys in the order they are inserted"""
+
+    if distribution == 'random':
+        return rng.sample(range(size * 10), size)
+    if distribution == 'sorted':
+        return list(range(size))
+    if distribution == 'reverse':
+        return list(range(size - 1, -1, -1))
+    if distribution == 'clustered':
+        # runs of consecutive keys around random centers, the runs in random order
+        starts = rng.sample(range(0, size * 100, CLUSTER), -(-size // CLUSTER))
+        keys = [start + i for start in starts for i in range(CLUSTER)]
+        return keys[:size]
+    raise ValueError('unknown distribution ' + distribution)
+
+
+def _clock(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def _insert_all(keys):
+    tree = RBTree()
+    for key in keys:
+        tree.insert(key)
+    return tree
+
+
+def _get_all(tree, keys):
+    return [tree.get_node(key) for key in keys]
+
+
+def _paths(tree, nodes):
+    for node in nodes:
+        list(tree.get_path(node))
+
+
+def _delete_all(tree, keys):
+    for key in keys:
+        tree.delete(key)
+
+
+def _export(tree):
+    f = io.BytesIO()
+    snapshot.dump(tree, f)
+    return f.getvalue()
+
+
+def _plotter():
+    """Returns a function timing TreeDrawer from loading a tree to its first drawn frame, or None without a GUI"""
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5 import QtCore, QtWidgets
+        import main
+    except ImportError:
+        return None
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    drawer = main.TreeDrawer()
+    drawer.canvas.resize(800, 600)
+
+    def plot(tree):
+        loop = QtCore.QEventLoop()
+        drawer.signals.rendered.connect(loop.quit)
+        QtCore.QTimer.singleShot(600000, loop.quit)
+        drawer.load(lambda: tree)
+        loop.exec_()
+        drawer.signals.rendered.disconnect(loop.quit)
+
+    plot.app = app
+    # the first frame pays for loading fonts and the canvas
+    plot(RBTree([0]))
+    return plot
+
+
+def run_suite(sizes, distributions, ops, seed=0, repeat=1, log=sys.stderr):
+    """Returns a list of results: op, distribution, size, count, seconds and ns per key, best of repeat"""
+
+    plot = _plotter() if 'plot' in ops else None
+    results = []
+
+    def add(op, distribution, size, count, seconds):
+        results.append({'op': op, 'distribution': distribution, 'size': size, 'count': count,
+                        'seconds': seconds, 'ns_per_key': seconds * 1e9 / max(count, 1)})
+        print('%-10s %-10s %9d %10.4f sec %10.0f ns/key' % (op, distribution, size, seconds,
+                                                            seconds * 1e9 / max(count, 1)), file=log)
+
+    for size in sizes:
+        for distribution in distributions:
+            rng = random.Random(seed)
+            keys = make_keys(distribution, size, rng)
+            sample = rng.sample(keys, min(size, SAMPLE))
+            best = {}
+
+            def keep(op, seconds):
+                best[op] = min(best.get(op, seconds), seconds)
+
+            for _ in range(repeat):
+                seconds, tree = _clock(_insert_all, keys)
+                keep('insert', seconds)
+                seconds, nodes = _clock(_get_all, tree, sample)
+                keep('get_node', seconds)
+                keep('get_path', _clock(_paths, tree, nodes)[0])
+                keep('delete', _clock(_delete_all, tree, sample)[0])
+                seconds, tree = _clock(RBTree.bulk_load, keys)
+                keep('bulk_load', seconds)
+                seconds, data = _clock(_export, tree)
+                keep('export', seconds)
+                keep('import', _clock(snapshot.load, io.BytesIO(data))[0])
+                if plot and size in PLOT_SIZES:
+                    keep('plot', _clock(plot, tree)[0])
+
+            counts = {'get_node': len(sample), 'get_path': len(sample), 'delete': len(sample), 'plot': 1}
+            for op in ops:
+                if op in best:
+                    add(op, distribution, size, counts.get(op, size), best[op])
+    return results
+
+
+def compare(results, baseline, threshold, floor=NOISE_FLOOR):
+    """
+    Prints the change against baseline per result, returns the results slower by more than threshold.
+    Results that took less than floor seconds in both runs are only printed: timer and scheduler
+    jitter alone moves them by more than any sensible threshold
+    """
+
+    old = {(r['op'], r['distribution'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        base = old.get((r['op'], r['distribution'], r['size']))
+        if base is None:
+            continue
+        ratio = r['seconds'] / base['seconds'] if base['seconds'] else 1.0
+        flag = ''
+        if max(r['seconds'], base['seconds']) < floor:
+            flag = 'below noise floor'
+        elif ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(r)
+        print('%-10s %-10s %9d %8.2fx %s' % (r['op'], r['distribution'], r['size'], ratio, flag),
+              file=sys.stderr)
+    return regressions
+
+
+def _list(convert):
+    return lambda value: [convert(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='RBTree benchmarks')
+    commands = parser.add_subparsers(dest='command')
+
+    suite = commands.add_parser('suite', help='time every operation, write JSON')
+    suite.add_argument('--sizes', type=_list(lambda item: int(float(item))), default=SIZES,
+                       help='comma separated, 1e7 is accepted')
+    suite.add_argument('--distributions', type=_list(str), default=DISTRIBUTIONS)
+    suite.add_argument('--ops', type=_list(str), default=OPS)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--repeat', type=int, default=REPEAT, help='keep the best of this many runs')
+    suite.add_argument('--output', help='write the JSON here instead of stdout')
+    suite.add_argument('--baseline', help='JSON of an earlier run to compare with')
+    suite.add_argument('--threshold', type=float, default=0.1,
+                       help='a slowdown above this fraction is a regression')
+    suite.add_argument('--noise-floor', type=float, default=NOISE_FLOOR,
+                       help='results faster than this many seconds in both runs are never a regression')
+
+    scaling = commands.add_parser('scaling', help='stack depth and delete rate')
+    scaling.add_argument('size', type=int, nargs='?', default=2000000)
+
+    args = parser.parse_args(argv)
+    if args.command == 'scaling':
+        bench_traversals(args.size)
+        bench_delete(sorted({10 ** 4, 10 ** 5, 10 ** 6, args.size}))
+        return 0
+    if args.command != 'suite':
+        parser.print_help()
+        return 2
+
+    unknown = set(args.ops) - set(OPS) or set(args.distributions) - set(DISTRIBUTIONS)
+    if unknown:
+        parser.error('unknown: ' + ', '.join(sorted(unknown)))
+
+    results = run_suite(args.sizes, args.distributions, args.ops, args.seed, args.repeat)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold, args.noise_floor):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+Headless batch mode: streams operations into an RBTree, no GUI modules are imported.
+
+    python cli.py [ops-file|-] [--load tree.rbtree] [--save tree.rbtree] [--no-times]
+                  [--key-type int|float|str]
+
+One operation per line, blank lines and lines starting with # are skipped:
+
+    insert KEY [KEY ...]
+    delete KEY [KEY ...]
+    search KEY
+    range LO HI
+
+Every operation prints one tab separated line: the operation, its arguments, the result
+and the time it took in nanoseconds. insert and delete print how many keys they added or
+removed, search prints the path from the root or 'missing', range prints the keys.
+Bad lines are reported on stderr, the exit status is 1 if there were any or if the
+snapshot could not be loaded or saved. With --save keys must fit into int64
+"""
+import argparse
+import sys
+import time
+
+from rbtree import RBTree
+
+
+def _insert(tree, keys):
+    if len(keys) == 1:
+        return int(tree.insert(keys[0]))
+    return tree.insert_many(keys)
+
+
+def _delete(tree, keys):
+    if len(keys) == 1:
+        return int(tree.delete(keys[0]))
+    return tree.delete_many(keys)
+
+
+def _search(tree, keys):
+    key, = keys
+    node = tree.get_node(key)
+    if node is None:
+        return 'missing'
+    return ' '.join(map(str, tree.get_path(node)))
+
+
+def _range(tree, keys):
+    lo, hi = keys
+    return ' '.join(map(str, tree.irange(lo, hi)))
+
+
+OPS = {'insert': _insert, 'delete': _delete, 'search': _search, 'range': _range}
+KEY_TYPES = {'int': int, 'float': float, 'str': str}
+INT64_MIN, INT64_MAX = -1 << 63, (1 << 63) - 1
+
+
+def _int64(word):
+    key = int(word)
+    if not INT64_MIN <= key <= INT64_MAX:
+        raise ValueError('key %d does not fit into int64' % key)
+    return key
+
+
+def run(tree, lines, out, times=True, err=sys.stderr, parse=int):
+    """
+    Applies the operations in lines to tree, writes the results to out.
+    parse turns every word after the operation into a key. Returns the number of bad lines
+    """
+
+    errors = 0
+    for number, line in enumerate(lines, 1):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        op = OPS.get(words[0])
+        try:
+            if op is None:
+                raise ValueError('unknown operation ' + words[0])
+            keys = [parse(word) for word in words[1:]]
+            start = time.perf_counter_ns()
+            result = op(tree, keys)
+            elapsed = time.perf_counter_ns() - start
+        except ValueError as e:
+            print('line %d: %s' % (number, e), file=err)
+            errors += 1
+            continue
+        fields = [words[0], ' '.join(words[1:]), str(result)]
+        if times:
+            fields.append(str(elapsed))
+        out.write('\t'.join(fields) + '\n')
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run RBTree operations from a file or stdin')
+    parser.add_argument('ops', nargs='?', default='-', help='file with one operation per line, - for stdin')
+    parser.add_argument('--load', help='start from this .rbtree snapshot')
+    parser.add_argument('--save', help='write the tree to this .rbtree snapshot at the end')
+    parser.add_argument('--no-times', dest='times', action='store_false', help='leave out the timings')
+    parser.add_argument('--key-type', choices=sorted(KEY_TYPES), default='int',
+                        help='how to parse keys, --load and --save need int')
+    args = parser.parse_args(argv)
+    if args.key_type != 'int' and (args.load or args.save):
+        parser.error('snapshots only hold int keys')
+
+    # keys that don't fit a snapshot are bad lines rather than a failed save at the end
+    parse = _int64 if args.save else KEY_TYPES[args.key_type]
+
+    if args.load or args.save:
+        import snapshot
+    try:
+        tree = snapshot.load(args.load) if args.load else RBTree()
+    except (snapshot.SnapshotError, OSError) as e:
+        print('cannot load %s: %s' % (args.load, e), file=sys.stderr)
+        return 1
+
+    if args.ops == '-':
+        errors = run(tree, sys.stdin, sys.stdout, args.times, parse=parse)
+    else:
+        with open(args.ops) as f:
+            errors = run(tree, f, sys.stdout, args.times, parse=parse)
+
+    if args.save:
+        try:
+            snapshot.dump(tree, args.save)
+        except (snapshot.SnapshotError, OSError) as e:
+            print('cannot save %s: %s' % (args.save, e), file=sys.stderr)
+            return 1
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,34 @@
 import sys
-import pickle
-import networkx as nx
 import time
-from rbtree import RBTree
-from PyQt5 import QtWidgets
+from concurrent.futures import ThreadPoolExecutor
+from rbtree import RBTree, RED
+from PyQt5 import QtCore, QtWidgets
 import random
+import numpy as np
+import metrics
+import snapshot
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.collections import LineCollection
 from matplotlib.figure import Figure
 
+RED_RGBA = (1.0, 0.0, 0.0, 1.0)
+BLACK_RGBA = (0.0, 0.0, 0.0, 1.0)
+GREEN_RGBA = (0.0, 0.5, 0.0, 1.0)
+GREY_RGBA = (0.5, 0.5, 0.5, 1.0)
+INF = float('inf')
+
+# above this many nodes labels are not drawn, they would overlap anyway,
+# and nodes shrink to dots
+MAX_LABELS = 1000
+SMALL_NODE_SIZE = 20
+
+# in trees larger than MAX_LABELS, subtrees whose children would be drawn closer
+# than this many pixels are collapsed into one summary glyph
+LOD_GAP_PIXELS = 30
+SUMMARY_SIZE = 150
+ZOOM_STEP = 1.25
+
 
 class Window(QtWidgets.QDialog):
 
@@ -37,7 +57,8 @@ class Window(QtWidgets.QDialog):
         self.remove_btn = QtWidgets.QPushButton('Remove')
         self.search_btn = QtWidgets.QPushButton('Search')
         self.gen_btn = QtWidgets.QPushButton('Gen')
-        self.timer_label = QtWidgets.QLabel('Search time: XXX sec')
+        self.timer_label = QtWidgets.QLabel('Lookup time: XXX sec')
+        self.render_label = QtWidgets.QLabel('Render time: XXX sec')
 
         self.add_btn.clicked.connect(self._add_btn_handler)
         self.remove_btn.clicked.connect(self._remove_btn_handler)
@@ -51,6 +72,7 @@ class Window(QtWidgets.QDialog):
         tree_mng_layout.addWidget(self.search_btn)
         tree_mng_layout.addWidget(self.gen_btn)
         tree_mng_layout.addWidget(self.timer_label)
+        tree_mng_layout.addWidget(self.render_label)
 
         tree_mng_groupbox.setLayout(tree_mng_layout)
 
@@ -82,6 +104,13 @@ class Window(QtWidgets.QDialog):
 
     def _init_tree_drawer(self):
         self.tree_drawer = TreeDrawer()
+        self.tree_drawer.signals.searched.connect(self._show_search_time)
+        self.tree_drawer.signals.rendered.connect(self._show_render_time)
+        self.tree_drawer.signals.failed.connect(self._show_error)
+
+    def closeEvent(self, event):
+        self.tree_drawer.close()
+        super(Window, self).closeEvent(event)
 
     def _add_btn_handler(self):
         if len(self.key_input.text()) == 0:
@@ -110,14 +139,17 @@ class Window(QtWidgets.QDialog):
         key = None
         try:
             key = int(self.key_input.text())
-            start_time = time.time()
             self.tree_drawer.search(key)
-            exec_time = time.time() - start_time
             self.key_input.clear()
-            self.timer_label.setText('Search time: %f sec' % exec_time)
         except ValueError:
             self._show_error('Int expected', 'The key should be a number!')
 
+    def _show_search_time(self, path, exec_time):
+        self.timer_label.setText('Lookup time: %f sec' % exec_time)
+
+    def _show_render_time(self, exec_time):
+        self.render_label.setText('Render time: %f sec' % exec_time)
+
     def _gen_btn_handler(self):
         if len(self.key_input.text()) == 0:
             return
@@ -125,11 +157,7 @@ class Window(QtWidgets.QDialog):
         key = None
         try:
             key = int(self.key_input.text())
-            elems = []
-            for i in range(0, key):
-                elems.append(random.randint(0, 1000000))
-            self.tree_drawer.tree = RBTree(elems)
-            self.tree_drawer.plot()
+            self.tree_drawer.load(lambda: RBTree.bulk_load(random.randint(0, 1000000) for i in range(key)))
         except ValueError:
             self._show_error('Int expected', 'The key should be a number!')
 
@@ -137,16 +165,13 @@ class Window(QtWidgets.QDialog):
         fname = QtWidgets.QFileDialog.getSaveFileName(self, 'Export RBTree', 'mytree.rbtree',
                                                       'Red-Black Tree files (*.rbtree)')[0]
         if fname:
-            with open(fname, 'wb') as f:
-                pickle.dump(self.tree_drawer.tree, f)
+            self.tree_drawer.export(fname)
 
     def _import_btn_handler(self):
         fname = QtWidgets.QFileDialog.getOpenFileName(self, 'Import RBTree', '',
                                                       'Red-Black Tree files (*.rbtree)')[0]
         if fname:
-            with open(fname, 'rb') as f:
-                self.tree_drawer.tree = pickle.load(f)
-            self.tree_drawer.plot()
+            self.tree_drawer.load(lambda: snapshot.load(fname), 'Import failed')
 
     def _show_error(self, title, message):
         msg = QtWidgets.QMessageBox()
@@ -158,159 +183,381 @@ class Window(QtWidgets.QDialog):
         self.key_input.clear()
 
 
+class DrawerSignals(QtCore.QObject):
+    """Results the worker thread of a TreeDrawer hands to the GUI thread"""
+
+    frame_ready = QtCore.pyqtSignal(object, object)
+    searched = QtCore.pyqtSignal(object, float)
+    rendered = QtCore.pyqtSignal(float)
+    failed = QtCore.pyqtSignal(str, str)
+
+
 class TreeDrawer:
+    """
+    Draws a tree on a matplotlib canvas. The tree is only touched by one worker thread:
+    mutations, searches, loading and the layout run there, one after another, so the
+    layout always sees a tree nobody is changing. Every redraw request gets a generation
+    number, the worker skips the layout for requests that a newer one has overtaken,
+    and the GUI thread only applies the last frame to the artists
+    """
 
     def __init__(self):
         self.tree = RBTree()
+        self.metrics = metrics.enable_metrics(self.tree)
         self.figure = Figure()
         self.canvas = FigureCanvas(self.figure)
-
-        pass
+        self.ax = self.figure.add_subplot(111)
+        self.ax.axis('off')
+
+        self.signals = DrawerSignals()
+        self.signals.frame_ready.connect(self._apply)
+        self.signals.searched.connect(self._show_found)
+        self._worker = ThreadPoolExecutor(max_workers=1)
+        self._generation = 0
+        # set by close: the worker drops its queue and nothing is signalled any more
+        self._closed = False
+
+        # artists of the drawn tree, kept between redraws
+        self._red = None
+        self._black = None
+        self._found = None
+        self._edges = None
+        self._summaries = None
+        self._labels = {}
+        self._summary_labels = []
+        # the drawn layout: keys in preorder, node coordinates in the same order
+        # and the index of every key in them
+        self._keys = []
+        self._xy = np.empty((0, 2))
+        self._index = {}
+        # the search path is animated: blitted over a saved background.
+        # It stays highlighted through pans and zooms until the tree changes
+        self._found_path = []
+        self._found_keys = []
+        self._background = None
+
+        # shown data limits (xmin, xmax, ymin, ymax), None fits the whole tree
+        self._view = None
+        self._drag = None
+        self.canvas.mpl_connect('scroll_event', self._on_scroll)
+        self.canvas.mpl_connect('button_press_event', self._on_press)
+        self.canvas.mpl_connect('motion_notify_event', self._on_motion)
+        self.canvas.mpl_connect('button_release_event', self._on_release)
+        self.canvas.mpl_connect('resize_event', lambda event: self.update())
+        self.canvas.mpl_connect('draw_event', self._on_draw)
 
     def insert(self, key):
-        self.tree.insert(key)
-        self.plot()
+        self._found_path = []
+        self._submit(lambda: self.tree.insert(key))
 
     def remove(self, key):
-        self.tree.delete(key)
-        self.plot()
+        self._found_path = []
+        self._submit(lambda: self.tree.delete(key))
 
     def search(self, key):
-        node = self.tree.get_node(key)
-        if node:
-            node_path = self.tree.get_path(node)
-            self.plot(self._color_search_path(node_path))
-
-    def plot(self, search_colors=None):
-        self.figure.clear()
-        ax = self.figure.add_subplot(111)
-        ax.clear()
-
-        if self.tree.root:
-
-            g = nx.Graph()
-
-            pos = self._get_pos_list(self.tree)
-            nodes = [x.key for x in self._preorder(self.tree)]
-            edges = self._get_edge_list(self.tree)
-            labels = {x: x for x in nodes}
-            if search_colors is None:
-                colors = []
-                try:
-                    colors = self._get_color_list(self.tree)
-                except AttributeError:
-                    pass
-            else:
-                colors = search_colors
-
-            g.add_nodes_from(nodes)
-            g.add_edges_from(edges)
-
-            max_len = len(str(self.tree.get_max().key))
-            size = max_len * 200
-            if len(colors) > 0:
-                nx.draw_networkx_nodes(g, pos, node_size=size, node_color=colors, ax=ax)
-                nx.draw_networkx_edges(g, pos, ax=ax)
-                nx.draw_networkx_labels(g, pos, labels, font_color='w', ax=ax,font_size=8)
-            else:
-                nx.draw_networkx_nodes(g, pos, node_size=size, node_color='r', ax=ax)
-                nx.draw_networkx_edges(g, pos, ax=ax)
-                nx.draw_networkx_labels(g, pos, labels, ax=ax,font_size=8)
-
-        ax.axis('off')
+        """
+        Looks key up on the worker, signals searched with the path and the time
+        get_node took as measured by the tree's metrics, without the path or the redraw
+        """
 
-        self.canvas.draw()
+        def find():
+            node = self.tree.get_node(key)
+            path = list(self.tree.get_path(node)) if node else None
+            if not self._closed:
+                self.signals.searched.emit(path, self.metrics.latency['lookup'].last / 1e9)
 
-    def _color_search_path(self, path):
-        nodes = [x.key for x in self._preorder(self.tree)]
-        colors = self._get_color_list(self.tree)
-        for p in path:
-            try:
-                pos = nodes.index(p)
-                colors[pos] = 'g'
-            except ValueError:
-                pass
-        return colors
-
-    def _get_pos_list(self, tree):
-        return self._get_pos_list_from(tree, tree.root, {}, (0, 0), 1.0)
-
-    def _get_pos_list_from(self, tree, node, poslst, coords, gap):
-        positions = poslst
-
-        if node and node.key == tree.root.key:
-            positions[node.key] = (0, 0)
-            positions = self._get_pos_list_from(tree, tree.root.left, positions, (0, 0), gap)
-            positions = self._get_pos_list_from(tree, tree.root.right, positions, (0, 0), gap)
-            return positions
-        elif node:
-            if node.parent.right and node.parent.right.key == node.key:
-                new_coords = (coords[0] + gap, coords[1] - 1)
-                positions[node.key] = new_coords
-            else:
-                new_coords = (coords[0] - gap, coords[1] - 1)
-                positions[node.key] = new_coords
-
-            positions = self._get_pos_list_from(tree, node.left, positions, new_coords, gap / 2)
-            positions = self._get_pos_list_from(tree, node.right, positions, new_coords, gap / 2)
-            return positions
-        else:
-            return positions
+        self._submit(find, redraw=False)
 
-    def _get_edge_list(self, tree):
-        return self._get_edge_list_from(tree, tree.root, [])
+    def load(self, factory, error_title='Load failed'):
+        """Replaces the tree with the one factory returns, calling it on the worker"""
 
-    def _get_edge_list_from(self, tree, node, edgelst):
-        edges = edgelst
+        def replace():
+            tree = factory()
+            self.metrics = metrics.enable_metrics(tree)
+            self.tree = tree
 
-        if node and node.key == tree.root.key:
-            if node.left:
-                edges.append((node.key, node.left.key))
-                edges = self._get_edge_list_from(tree, node.left, edges)
-            if node.right:
-                edges.append((node.key, node.right.key))
-                edges = self._get_edge_list_from(tree, node.right, edges)
+        self._clear()
+        self._view = None
+        self._submit(replace, error_title=error_title)
 
-            return edges
+    def export(self, fname):
+        self._submit(lambda: snapshot.dump(self.tree, fname), redraw=False, error_title='Export failed')
 
-        elif node:
-            if node.left:
-                edges.append((node.key, node.left.key))
-            if node.right:
-                edges.append((node.key, node.right.key))
+    def close(self):
+        """Cancels the queued jobs, a job already running finishes without signalling"""
 
-            edges = self._get_edge_list_from(tree, node.left, edges)
-            edges = self._get_edge_list_from(tree, node.right, edges)
-            return edges
+        self._closed = True
+        self._worker.shutdown(wait=False, cancel_futures=True)
 
-        else:
-            return edges
+    def plot(self):
+        """Draws the tree from scratch, after the whole tree has been replaced"""
+
+        self._clear()
+        self._view = None
+        self.update()
+
+    def update(self):
+        """Redraws the tree for the current view, after a mutation, pan or zoom"""
+
+        self._submit(None)
 
-    def _preorder(self, tree, *args):
-        if len(args) == 0:
-            elements = []
-            node = tree.root
+    def _submit(self, job, redraw=True, error_title='Operation failed'):
+        """
+        Queues job for the worker thread, followed by a frame for the current view if redraw is set.
+        An exception raised by job is signalled as failed with error_title
+        """
+
+        if redraw:
+            self._generation += 1
+        return self._worker.submit(self._run, job, redraw and self._generation,
+                                   self._view, self.ax.bbox.width, error_title)
+
+    def _run(self, job, generation, view, width, error_title):
+        """Runs on the worker thread"""
+
+        if self._closed:
+            return
+        if job:
+            try:
+                job()
+            except Exception as e:
+                if not self._closed:
+                    self.signals.failed.emit(error_title, str(e))
+        # a newer request is queued behind this one, its frame will do
+        if generation and generation == self._generation and not self._closed:
+            self.signals.frame_ready.emit(generation, self._frame(view, width))
+
+    def _frame(self, view, width):
+        """
+        Lays the tree out on the worker thread.
+        Only subtrees inside the view are laid out. In a tree of more than MAX_LABELS keys
+        subtrees narrower than LOD_GAP_PIXELS on screen are drawn as one summary glyph,
+        so the cost is bounded by the size of the canvas, not of the tree
+        """
+
+        if not self.tree.root:
+            return None
+
+        # the whole tree is about 4 units wide
+        units = 4.0 if view is None else view[1] - view[0]
+        min_gap = 0
+        if len(self.tree) > MAX_LABELS:
+            min_gap = LOD_GAP_PIXELS * units / max(width, 1)
+        keys, xy, red, segments, summary_xy, summaries = self._layout(self.tree, view, min_gap)
+        if len(keys) > MAX_LABELS:
+            size = SMALL_NODE_SIZE
         else:
-            node = tree
-            elements = args[0]
+            size = len(str(self.tree.get_max().key)) * 200
+        index = {key: i for i, key in enumerate(keys)}
+        return view, keys, xy, red, segments, summary_xy, summaries, size, index
+
+    def _clear(self):
+        self.ax.clear()
+        self.ax.axis('off')
+        self._red = None
+        self._black = None
+        self._found = None
+        self._edges = None
+        self._summaries = None
+        self._labels = {}
+        self._summary_labels = []
+        self._keys = []
+        self._xy = np.empty((0, 2))
+        self._index = {}
+        self._found_path = []
+        self._found_keys = []
+        self._background = None
+
+    def _apply(self, generation, frame):
+        """
+        Brings the kept artists in line with a frame from the worker, on the GUI thread.
+        Every collection gets its new offsets or segments in one call,
+        labels are only created, moved or removed for nodes that appeared, moved or disappeared.
+        Draws right away and signals rendered with the time it took
+        """
+
+        if generation != self._generation or self._closed:
+            return
+        start_time = time.perf_counter()
+        if frame is None:
+            if self._keys:
+                self._clear()
+            self.canvas.draw_idle()
+            return
+        view, keys, xy, red, segments, summary_xy, summaries, size, index = frame
+
+        if self._edges is None:
+            self._edges = LineCollection(segments, colors='k', zorder=1)
+            self.ax.add_collection(self._edges)
+            # one collection per color: matplotlib stamps uniform markers much faster
+            self._red = self.ax.scatter([], [], c=[RED_RGBA], linewidths=0, zorder=2)
+            self._black = self.ax.scatter([], [], c=[BLACK_RGBA], linewidths=0, zorder=2)
+            self._found = self.ax.scatter([], [], c=[GREEN_RGBA], linewidths=0, animated=True)
+            self._summaries = self.ax.scatter([], [], c=[GREY_RGBA], marker='^', linewidths=0, zorder=2)
+        else:
+            self._edges.set_segments(segments)
+        self._red.set_offsets(xy[red])
+        self._black.set_offsets(xy[~red])
+        for nodes in (self._red, self._black, self._found):
+            nodes.set_sizes([size])
+        self._summaries.set_offsets(summary_xy)
+        self._summaries.set_sizes([SUMMARY_SIZE])
+        self._update_labels(keys, xy)
+
+        for label in self._summary_labels:
+            label.remove()
+        self._summary_labels = [
+            self.ax.text(x, y - 0.15, '%d\nbh %d' % summary, size=6, zorder=3,
+                         horizontalalignment='center', verticalalignment='top')
+            for (x, y), summary in zip(summary_xy.tolist(), summaries)
+        ]
+
+        if view is None:
+            self.ax.ignore_existing_data_limits = True
+            self.ax.update_datalim(xy)
+            self.ax.update_datalim(summary_xy)
+            self.ax.set_autoscale_on(True)
+            self.ax.autoscale_view()
+        else:
+            xmin, xmax, ymin, ymax = view
+            self.ax.set_xlim(xmin, xmax)
+            self.ax.set_ylim(ymin, ymax)
+        self._keys = keys
+        self._xy = xy
+        self._index = index
+        self._place_found()
+        self._background = None
+        self.canvas.draw()
+        self.signals.rendered.emit(time.perf_counter() - start_time)
 
-        elements.append(node)
+    def _show_found(self, path, seconds):
+        """Highlights the part of a search path that is drawn"""
 
-        if node.left:
-            self._preorder(node.left, elements)
-        if node.right:
-            self._preorder(node.right, elements)
+        if not path or self._found is None or self._closed:
+            return
+        self._found_path = path
+        self._place_found()
+        if self._background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._background)
+        self._draw_found()
+        self.canvas.blit(self.ax.bbox)
+
+    def _update_labels(self, keys, xy):
+        """Makes the labels follow their nodes. Above MAX_LABELS nodes no labels are drawn"""
+
+        if len(keys) > MAX_LABELS:
+            keys = []
+        pos = dict(zip(keys, map(tuple, xy.tolist())))
+        for key in self._labels.keys() - pos.keys():
+            self._labels.pop(key).remove()
+        for key, (x, y) in pos.items():
+            label = self._labels.get(key)
+            if label is None:
+                self._labels[key] = self.ax.text(x, y, str(key), color='w', size=8, zorder=3,
+                                                 horizontalalignment='center',
+                                                 verticalalignment='center')
+            elif label.get_position() != (x, y):
+                label.set_position((x, y))
+
+    def _place_found(self):
+        self._found_keys = [key for key in self._found_path if key in self._index]
+        self._found.set_offsets(self._xy[[self._index[key] for key in self._found_keys]])
+
+    def _on_draw(self, event):
+        """Saves the background for blitting, then puts the search path back over it"""
+
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_found()
+
+    def _draw_found(self):
+        """Draws the green search path and its labels on top of what is on the canvas"""
+
+        if not self._found_keys:
+            return
+        self.ax.draw_artist(self._found)
+        for key in self._found_keys:
+            label = self._labels.get(key)
+            if label:
+                self.ax.draw_artist(label)
 
-        return elements
+    def _on_scroll(self, event):
+        """Zooms around the cursor"""
+
+        if event.inaxes is not self.ax:
+            return
+        factor = ZOOM_STEP ** -event.step
+        # the axes lag behind the view while the worker lays it out
+        xmin, xmax, ymin, ymax = self._view or self.ax.get_xlim() + self.ax.get_ylim()
+        x, y = event.xdata, event.ydata
+        self._view = (x + (xmin - x) * factor, x + (xmax - x) * factor,
+                      y + (ymin - y) * factor, y + (ymax - y) * factor)
+        self.update()
+
+    def _on_press(self, event):
+        """Starts panning, a double click fits the whole tree again"""
+
+        if event.inaxes is not self.ax or event.button != 1:
+            return
+        if event.dblclick:
+            self._view = None
+            self.update()
+            return
+        self._drag = (event.x, event.y, self.ax.get_xlim(), self.ax.get_ylim())
 
-    def _get_color_list(self, tree):
-        nodelist = self._preorder(tree)
-        colorlist = []
-        for node in nodelist:
-            if node.color:
-                colorlist.append(node.color)
+    def _on_motion(self, event):
+        if self._drag is None:
+            return
+        x, y, (xmin, xmax), (ymin, ymax) = self._drag
+        dx = (event.x - x) * (xmax - xmin) / self.ax.bbox.width
+        dy = (event.y - y) * (ymax - ymin) / self.ax.bbox.height
+        self._view = (xmin - dx, xmax - dx, ymin - dy, ymax - dy)
+        self.update()
+
+    def _on_release(self, event):
+        self._drag = None
+
+    def _layout(self, tree, view=None, min_gap=0):
+        """
+        Walks the tree once. Returns its keys in preorder, and in the same order
+        node coordinates and a mask of red nodes, plus one segment per edge, as arrays.
+        With a view (xmin, xmax, ymin, ymax) subtrees outside of it are skipped.
+        Subtrees whose children are closer than min_gap are not descended, their roots
+        are returned as summaries: coordinates and (number of keys, black height)
+        """
+
+        xmin, xmax, ymin, ymax = view or (-INF, INF, -INF, INF)
+        keys = []
+        coords = []
+        red = []
+        segments = []
+        summary_coords = []
+        summaries = []
+        stack = [(tree.root, None, 0.0, 0.0, 1.0)]
+        while stack:
+            node, parent, x, y, gap = stack.pop()
+            if parent:
+                segments.append((parent, (x, y)))
+            # a subtree spans less than 2 * gap to either side of its root
+            if x + 2 * gap < xmin or x - 2 * gap > xmax or y < ymin:
+                continue
+            if gap < min_gap and (node.left or node.right):
+                summary_coords.append((x, y))
+                summaries.append((node.size, tree._black_height(node)))
+                continue
+
+            keys.append(node.key)
+            coords.append((x, y))
+            red.append(node.color == RED)
+            if node.right:
+                stack.append((node.right, (x, y), x + gap, y - 1, gap / 2))
+            if node.left:
+                stack.append((node.left, (x, y), x - gap, y - 1, gap / 2))
 
-        return colorlist
+        return (keys, np.array(coords, dtype=float).reshape(-1, 2), np.array(red, dtype=bool),
+                np.array(segments, dtype=float).reshape(-1, 2, 2),
+                np.array(summary_coords, dtype=float).reshape(-1, 2), summaries)
 
 
 if __name__ == '__main__':
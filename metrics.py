@@ -0,0 +1,133 @@
+"""
+Opt-in instrumentation for RBTree.
+
+enable_metrics(tree) wraps insert, delete, get_node and find_many of one tree instance
+with timers recording perf_counter_ns latencies into log2 histograms, `in` goes through
+the timed get_node. The tree then also counts rotations, recolors and every fix-up case
+it enters. The insert cases run by joins (split and the set operations) are counted
+as join_case_*. Trees without metrics pay one attribute check per fix-up step and per `in`
+"""
+import collections
+import functools
+import time
+
+TIMED = {'insert': 'insert', 'delete': 'delete', 'get_node': 'lookup', 'find_many': 'lookup_many'}
+
+
+class Histogram:
+    """Latencies in nanoseconds, bucket i counts values of bit length i: [2 ** (i - 1), 2 ** i)"""
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def record(self, ns):
+        self.buckets[min(ns.bit_length(), 63)] += 1
+        self.count += 1
+        self.total += ns
+        self.last = ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if self.max is None or ns > self.max:
+            self.max = ns
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket holding the q-th quantile, 0 <= q <= 1"""
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return 1 << i
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total_ns': self.total,
+            'mean_ns': self.total / self.count if self.count else None,
+            'min_ns': self.min,
+            'max_ns': self.max,
+            'last_ns': self.last,
+            'p50_ns': self.percentile(0.5),
+            'p99_ns': self.percentile(0.99),
+            'buckets': {1 << i: count for i, count in enumerate(self.buckets) if count},
+        }
+
+
+class Metrics:
+    """Latency histograms per operation and counters of the work done by the fix-ups"""
+
+    def __init__(self):
+        self.latency = {name: Histogram() for name in TIMED.values()}
+        self.rotations = 0
+        self.recolors = 0
+        self.cases = collections.Counter()
+        # the prefix of the insert fix-up cases, 'join' while a join runs them
+        self.fixup = 'insert'
+        # set while a timed call runs, so the lookup inside delete is not timed on its own
+        self._busy = False
+
+    def hit(self, case):
+        self.cases[case] += 1
+
+    def snapshot(self):
+        """Returns the current numbers as plain dicts, safe to keep or serialize"""
+
+        return {
+            'latency': {name: histogram.snapshot() for name, histogram in self.latency.items()},
+            'rotations': self.rotations,
+            'recolors': self.recolors,
+            'cases': dict(self.cases),
+        }
+
+    def reset(self):
+        self.__init__()
+
+
+def _timed(metrics, name, func):
+    histogram = metrics.latency[name]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if metrics._busy:
+            return func(*args, **kwargs)
+        metrics._busy = True
+        start = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+            metrics._busy = False
+
+    return wrapper
+
+
+def enable_metrics(tree):
+    """Starts collecting metrics for tree, returns its Metrics. Calling it again keeps the old ones"""
+
+    if tree._stats is not None:
+        return tree._stats
+    metrics = Metrics()
+    for method, name in TIMED.items():
+        setattr(tree, method, _timed(metrics, name, getattr(tree, method)))
+    tree._stats = metrics
+    return metrics
+
+
+def disable_metrics(tree):
+    """Stops collecting metrics for tree, returns the Metrics it had or None"""
+
+    metrics = tree._stats
+    if metrics is not None:
+        for method in TIMED:
+            delattr(tree, method)
+        del tree._stats
+    return metrics
@@ -1,107 +1,405 @@
-import collections
+import bisect
+import collections.abc
+import contextlib
+import gc
+
+
+BLACK = 0
+RED = 1
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """
+    Pauses the cyclic GC while a batch of nodes is allocated.
+    Otherwise every few hundred new nodes trigger a collection that scans the whole tree
+    """
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 
 class Node:
-    """A Red-Black-Tree node"""
+    """
+    A Red-Black-Tree node.
+    Slotted, with an int color (RED or BLACK), the size of its subtree and an optional value:
+    about 88 bytes per node on 64-bit CPython (72 bytes of object plus the 16 byte GC header),
+    not counting the key and value objects themselves. With int keys below 2**30 (28 bytes each)
+    and no values plan for about 120 bytes per key
+    """
+
+    __slots__ = ('left', 'right', 'parent', 'key', 'value', 'color', 'size')
 
-    def __init__(self, key):
+    def __init__(self, key, value=None):
         self.left = None
         self.right = None
         self.parent = None
         self.key = key
-        self.color = 'r'
+        self.value = value
+        self.color = RED
+        self.size = 1
 
 
-class RBTree:
-    """A Red-Black-Tree"""
+class KeyedNode(Node):
+    """A node of a tree with a key function: key is the cached key(item), item the key as passed in"""
+
+    __slots__ = ('item',)
 
-    def __init__(self, *args):
+    def __init__(self, key, item, value=None):
+        super().__init__(key, value)
+        self.item = item
+
+
+class RBTree:
+    """
+    A Red-Black-Tree of any totally ordered keys, optionally mapping every key to a value.
+    With a key function the tree orders keys by key(k), computed once per key and cached
+    in its KeyedNode, and hands the keys back as they were passed in, like sorted(key=...)
+    or SortedKeyList. Keys with equal key(k) count as the same key, lookups, ranges and
+    deletes take keys and map them too. Without one (the common int case) keys are
+    compared as they are and no call is added to any descent
+    """
+
+    # an optional mutation log, see wal.Store. A change is packed with _log.pack(op, keys, values=()),
+    # op one of 'insert', 'delete', 'retain', 'clear', before the tree is touched, so a change
+    # the log can't hold fails without applying. Once applied it goes out with _log.write(record)
+    _log = None
+    # optional metrics.Metrics, see metrics.enable_metrics
+    _stats = None
+    # optional key function, see the class docstring
+    key = None
+
+    def __init__(self, iterable=None, key=None):
         self.root = None
+        if key is not None:
+            self.key = key
 
-        if len(args) == 1:
-            if isinstance(args[0], collections.Iterable):
-                for x in args[0]:
-                    self.insert(x)
+        if iterable is not None:
+            if isinstance(iterable, collections.abc.Iterable):
+                with _gc_paused():
+                    self.root = self._link_sorted(self._nodes_from_sorted(sorted(iterable, key=key), key))
             else:
-                raise TypeError(str(args[0]) + " is not iterable")
+                raise TypeError(str(iterable) + " is not iterable")
 
-    def get_node(self, key, *args):
-        """Returns a node by key. Second optional param is a node to start searching from"""
+    @classmethod
+    def from_sorted(cls, keys, key=None):
+        """
+        Builds a tree from keys in ascending order in linear time, without fix-ups.
+        Repeated keys are skipped, ValueError is raised if keys are not sorted
+        """
 
-        if len(args) == 0:
-            start = self.root
-        else:
-            start = args[0]
+        tree = cls(key=key)
+        with _gc_paused():
+            tree.root = cls._link_sorted(cls._nodes_from_sorted(keys, key))
+        return tree
+
+    @classmethod
+    def bulk_load(cls, iterable, key=None):
+        """
+        Builds a tree from keys in any order.
+        Sorting already sorted input is linear, so is the build itself
+        """
+
+        tree = cls(key=key)
+        with _gc_paused():
+            tree.root = cls._link_sorted(cls._nodes_from_sorted(sorted(iterable, key=key), key))
+        return tree
+
+    @staticmethod
+    def _nodes_from_sorted(keys, key=None):
+        """Returns new nodes for sorted keys, skipping repeats. With a key function they are KeyedNodes"""
+
+        nodes = []
+        append = nodes.append
+        if key is not None:
+            for item in keys:
+                order = key(item)
+                if nodes and order <= prev:
+                    if order == prev:
+                        continue
+                    raise ValueError("keys are not sorted: " + str(item) + " after " + str(nodes[-1].item))
+                append(KeyedNode(order, item))
+                prev = order
+            return nodes
+
+        for key in keys:
+            if nodes and key <= prev:
+                if key == prev:
+                    continue
+                raise ValueError("keys are not sorted: " + str(key) + " after " + str(prev))
+            append(Node(key))
+            prev = key
+        return nodes
+
+    @staticmethod
+    def _link_sorted(nodes):
+        """
+        Links nodes sorted by key into a balanced tree and returns its root.
+        Every level but the deepest one is full. The deepest level is colored red
+        and the rest black, so every path has the same number of black nodes
+        """
 
-        if not start:
+        if not nodes:
             return None
-        if key == start.key:
-            return start
-        elif key > start.key:
-            return self.get_node(key, start.right)
+
+        red_depth = len(nodes).bit_length() - 1
+        root = None
+        stack = [(0, len(nodes), None, False, 0)]
+        while stack:
+            lo, hi, parent, is_left, depth = stack.pop()
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            node.parent = parent
+            node.left = None
+            node.right = None
+            node.color = RED if depth == red_depth else BLACK
+            node.size = hi - lo
+            if parent is None:
+                root = node
+            elif is_left:
+                parent.left = node
+            else:
+                parent.right = node
+
+            if mid + 1 < hi:
+                stack.append((mid + 1, hi, node, False, depth + 1))
+            if lo < mid:
+                stack.append((lo, mid, node, True, depth + 1))
+
+        root.color = BLACK
+        return root
+
+    def get_node(self, key, start=None):
+        """Returns a node by key. Second optional param is a node to start searching from"""
+
+        if self.key is not None:
+            key = self.key(key)
+        node = self.root if start is None else start
+        while node:
+            if key > node.key:
+                node = node.right
+            elif key < node.key:
+                node = node.left
+            else:
+                return node
+        return None
+
+    def _get_node(self, key):
+        """get_node for a key that is already mapped by the key function"""
+
+        node = self.root
+        while node:
+            if key > node.key:
+                node = node.right
+            elif key < node.key:
+                node = node.left
+            else:
+                return node
+        return None
+
+    def __contains__(self, key):
+        if self._stats is not None:
+            # through the timed get_node of metrics.enable_metrics
+            return self.get_node(key) is not None
+        if self.key is not None:
+            key = self.key(key)
+        node = self.root
+        while node:
+            if key > node.key:
+                node = node.right
+            elif key < node.key:
+                node = node.left
+            else:
+                return True
+        return False
+
+    def get(self, key, default=None):
+        """
+        Returns a node by key or default if there is no such key, like get of ArrayRBTree
+        and SnapshotView. tree[key] returns the value
+        """
+
+        node = self.get_node(key)
+        return default if node is None else node
+
+    def __getitem__(self, key):
+        """Returns the value of key, raises KeyError if there is no such key"""
+
+        node = self.get_node(key)
+        if node is None:
+            raise KeyError(key)
+        return node.value
+
+    def __setitem__(self, key, value):
+        """Maps key to value, inserting key if it is not in the tree yet"""
+
+        node = self.get_node(key)
+        if node is None:
+            self.insert(key, value)
         else:
-            return self.get_node(key, start.left)
+            if self._log is not None:
+                # an existing key keeps its record, only checks the value
+                self._log.pack('insert', (key,), (value,))
+            node.value = value
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def items(self):
+        """Iterates over (key, value) pairs in ascending order of keys"""
+
+        if self.key is not None:
+            for node in self._iter_nodes():
+                yield node.item, node.value
+            return
+        for node in self._iter_nodes():
+            yield node.key, node.value
+
+    def values(self):
+        """Iterates over the values in ascending order of keys"""
+
+        for node in self._iter_nodes():
+            yield node.value
+
+    def find_many(self, keys):
+        """
+        Returns a list of nodes for keys (None for a missing key), in the order of keys.
+        The queries are sorted and resolved in one walk: every node is visited
+        at most once and splits the sorted queries between its subtrees
+        """
+
+        keys = list(keys) if self.key is None else [self.key(key) for key in keys]
+        queries = self._unique(sorted(keys))
+        found = self._find_sorted(queries)
+        return [found[bisect.bisect_left(queries, key)] for key in keys]
+
+    @staticmethod
+    def _unique(keys):
+        """Drops the repeats from a sorted list. Keys only need to be ordered, not hashable"""
+
+        return [key for i, key in enumerate(keys) if not i or keys[i - 1] < key]
+
+    def _find_sorted(self, queries):
+        """Returns the node of every key in queries, which are sorted and distinct, or None for a missing one"""
+
+        found = [None] * len(queries)
+        stack = [(self.root, 0, len(queries))]
+        while stack:
+            node, lo, hi = stack.pop()
+            if not node or lo >= hi:
+                continue
+            mid = bisect.bisect_left(queries, node.key, lo, hi)
+            if mid < hi and queries[mid] == node.key:
+                found[mid] = node
+                stack.append((node.right, mid + 1, hi))
+            else:
+                stack.append((node.right, mid, hi))
+            stack.append((node.left, lo, mid))
+        return found
 
     def get_path(self, node):
         """Returns a path-list of keys from root to taken node"""
 
+        attr = 'key' if self.key is None else 'item'
         curr = node
-        lst = [curr.key]
+        lst = [getattr(curr, attr)]
         while curr.parent is not None:
             curr = curr.parent
-            lst.append(curr.key)
+            lst.append(getattr(curr, attr))
 
         return reversed(lst)
 
-    def insert(self, key, *args):
-        """Insert a node with key"""
+    def insert(self, key, value=None):
+        """
+        Insert a node with key and an optional value.
+        Looks for a free slot and for a duplicate in one iterative descent.
+        Returns True if the key was not in the tree yet, an existing key keeps its value
+        """
 
-        if not isinstance(key, int):
-            raise TypeError(str(key) + " is not an int")
-        else:
-            if not self.root:
-                self.root = Node(key)
-                self.root.color = 'k'
-            elif len(args) == 0:
-                if not self.get_node(key):
-                    self.insert(key, self.root)
-            else:
-                child = Node(key)
-                parent = args[0]
-                if child.key > parent.key:
+        if self.key is not None:
+            return self._insert_keyed(key, value)
+        record = None if self._log is None else self._log.pack('insert', (key,), (value,))
+        parent = self.root
+        if not parent:
+            self.root = Node(key, value)
+            self.root.color = BLACK
+            if record is not None:
+                self._log.write(record)
+            return True
+
+        try:
+            while True:
+                parent.size += 1
+                if key > parent.key:
                     if not parent.right:
-                        parent.right = child
-                        child.parent = parent
-                        if parent.color == 'r':
-                            self._insert_case_one(child)
-                    else:
-                        self.insert(key, parent.right)
-                else:
+                        child = parent.right = Node(key, value)
+                        break
+                    parent = parent.right
+                elif key < parent.key:
                     if not parent.left:
-                        parent.left = child
-                        child.parent = parent
-                        if parent.color == 'r':
-                            self._insert_case_one(child)
-                    else:
-                        self.insert(key, parent.left)
+                        child = parent.left = Node(key, value)
+                        break
+                    parent = parent.left
+                else:
+                    self._shrink_path(parent)
+                    return False
+        except TypeError:
+            # a key that does not compare with the keys in the tree
+            self._shrink_path(parent)
+            raise
+
+        child.parent = parent
+        if parent.color == RED:
+            self._insert_case_one(child)
+        if record is not None:
+            self._log.write(record)
+        return True
+
+    # insert_many inserts key by key through this name, which metrics.enable_metrics does not time
+    _insert = insert
+
+    def _insert_keyed(self, key, value):
+        """insert for a tree with a key function, the node keeps key and caches key(key)"""
+
+        node = KeyedNode(self.key(key), key, value)
+        record = None if self._log is None else self._log.pack('insert', (node.key,), (value,))
+        added = self._insert_nodes([node])
+        if added and record is not None:
+            self._log.write(record)
+        return added == 1
 
     def _insert_case_one(self, child):
         """
         if child is at the root, recolors it black,
-        else goes into the second case
+        else goes into the second case.
+        Returns True if the root was recolored, so the black height of the tree grew
         """
+        if self._stats is not None:
+            self._stats.hit(self._stats.fixup + '_case_one')
         if not child.parent:
-            self.root.color = 'k'
+            self.root.color = BLACK
+            if self._stats is not None:
+                self._stats.recolors += 1
+            return True
         else:
-            self._insert_case_two(child)
+            return self._insert_case_two(child)
 
     def _insert_case_two(self, child):
         """
         If child's parent is black - ok,
         else goes into the third case
         """
-        if child.parent.color == 'r':
-            self._insert_case_three(child)
+        if self._stats is not None:
+            self._stats.hit(self._stats.fixup + '_case_two')
+        if child.parent.color == RED:
+            return self._insert_case_three(child)
+        return False
 
     def _insert_case_three(self, child):
         """
@@ -110,6 +408,8 @@ class RBTree:
         Then start with the first case on grandpa to validate the tree (grandgrandpa may be also red)
         Otherwise goes into the fourth case
         """
+        if self._stats is not None:
+            self._stats.hit(self._stats.fixup + '_case_three')
 
         parent = child.parent
         grand_node = parent.parent
@@ -119,13 +419,16 @@ class RBTree:
         else:
             uncle = grand_node.left
 
-        if uncle and uncle.color == 'r':
-            grand_node.color = 'r'
-            parent.color = 'k'
-            uncle.color = 'k'
-            self._insert_case_one(grand_node)
+        if uncle and uncle.color == RED:
+            grand_node.color = RED
+            parent.color = BLACK
+            uncle.color = BLACK
+            if self._stats is not None:
+                self._stats.recolors += 3
+            return self._insert_case_one(grand_node)
         else:
             self._insert_case_four(child)
+            return False
 
     def _insert_case_four(self, child):
         """
@@ -134,6 +437,8 @@ class RBTree:
         the child is the right child of the parent or vice versa
         makes tree rotations around parent and goes into the fifth child
         """
+        if self._stats is not None:
+            self._stats.hit(self._stats.fixup + '_case_four')
         parent = child.parent
         grand_node = parent.parent
         if grand_node.left == parent:
@@ -157,6 +462,8 @@ class RBTree:
         or vice versa
         makes tree rotations around the grandpa
         """
+        if self._stats is not None:
+            self._stats.hit(self._stats.fixup + '_case_five')
         parent = child.parent
         grand_node = parent.parent
         if grand_node.left == parent:
@@ -165,13 +472,15 @@ class RBTree:
             uncle = grand_node.left
 
         if parent.left == child:
-            grand_node.color = 'r'
-            parent.color = 'k'
+            grand_node.color = RED
+            parent.color = BLACK
             self._rotate_right(grand_node)
         elif parent.right == child:
-            grand_node.color = 'r'
-            parent.color = 'k'
+            grand_node.color = RED
+            parent.color = BLACK
             self._rotate_left(grand_node)
+        if self._stats is not None:
+            self._stats.recolors += 2
 
     def _rotate_left(self, pivot):
         """
@@ -181,7 +490,6 @@ class RBTree:
         parent = old_root.parent
 
         new_root = old_root.right
-        temp = new_root.right
         old_root.right = new_root.left
 
         if old_root.right:
@@ -189,16 +497,19 @@ class RBTree:
         new_root.left = old_root
         old_root.parent = new_root
 
+        new_root.size = old_root.size
+        old_root.size = 1 + (old_root.left.size if old_root.left else 0) + \
+            (old_root.right.size if old_root.right else 0)
+        if self._stats is not None:
+            self._stats.rotations += 1
+
+        new_root.parent = parent
         if parent is None:
             self.root = new_root
-            self.root.parent = None
+        elif parent.right is old_root:
+            parent.right = new_root
         else:
-            if parent.right and parent.right.key == old_root.key:
-                parent.right = new_root
-                new_root.parent = parent
-            elif parent.left and parent.left.key == old_root.key:
-                parent.left = new_root
-                new_root.parent = parent
+            parent.left = new_root
 
     def _rotate_right(self, pivot):
         """
@@ -211,7 +522,6 @@ class RBTree:
             parent = old_root.parent
 
             new_root = old_root.left
-            temp = new_root.left
             old_root.left = new_root.right
 
             if (old_root.left):
@@ -220,362 +530,1094 @@ class RBTree:
             new_root.right = old_root
             old_root.parent = new_root
 
+            new_root.size = old_root.size
+            old_root.size = 1 + (old_root.left.size if old_root.left else 0) + \
+                (old_root.right.size if old_root.right else 0)
+            if self._stats is not None:
+                self._stats.rotations += 1
+
+            new_root.parent = parent
             if parent is None:
                 self.root = new_root
-                self.root.parent = None
+            elif parent.right is old_root:
+                parent.right = new_root
             else:
-                if parent.right and parent.right.key == old_root.key:
-                    parent.right = new_root
-                    new_root.parent = parent
-                elif parent.left and parent.left.key == old_root.key:
-                    parent.left = new_root
-                    new_root.parent = parent
-
-    # def get_element_count(self, *args):
-    #     """
-    #     Counts the number of elements in a tree
-    #     """
-    #     if len(args) == 0:
-    #         node = self.root
-    #     else:
-    #         node = args[0]
-    #
-    #     left = 0
-    #     right = 0
-    #
-    #     if node:
-    #         if node.left:
-    #             left = self.get_element_count(node.left)
-    #         if node.right:
-    #             right = self.get_element_count(node.right)
-    #
-    #         return 1 + left + right
-    #     else:
-    #         return 0
+                parent.left = new_root
 
-    def delete(self, key):
-        node = self.get_node(key, self.root)
-        if node:
-            if node == self.root:
-                self.root = None
-            elif not (node.left or node.right):
-                if node.parent:
-                    self._delete_leaf(node)
+    def __len__(self):
+        return self.root.size if self.root else 0
 
-            elif not (node.left and node.right):
-                self._delete_leaf_parent(node)
+    def _shrink_path(self, node):
+        """Decrements subtree sizes from node up to the root"""
 
-            else:
-                self._delete_node(node)
+        while node:
+            node.size -= 1
+            node = node.parent
 
-    def _delete_node(self, node):
-        if self.get_height(node.left) > self.get_height(node.right):
-            to_switch = self.get_max(node.left)
-            self._switch_nodes(node, to_switch)
+    def rank(self, key):
+        """Returns the number of keys less than key"""
 
-            if not (to_switch.right or to_switch.left):
-                to_delete = self.get_max(node.left)
-                self._delete_leaf(to_delete)
-            else:
-                to_delete = self.get_max(node.left)
-                self._delete_leaf_parent(to_delete)
-        else:
-            to_switch = self.get_min(node.right)
-            self._switch_nodes(node, to_switch)
+        if self.key is not None:
+            key = self.key(key)
+        return self._count_less(key, False)
 
-            if not (to_switch.right or to_switch.left):
-                to_delete = self.get_min(node.right)
-                self._delete_leaf(to_delete)
+    def _count_less(self, key, inclusive):
+        count = 0
+        node = self.root
+        while node:
+            if key > node.key or (inclusive and key == node.key):
+                count += 1 + (node.left.size if node.left else 0)
+                node = node.right
+            else:
+                node = node.left
+        return count
+
+    def select(self, index):
+        """Returns the key with the given index in ascending order. Negative indexes count from the end"""
+
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("tree index out of range")
+
+        node = self.root
+        while True:
+            left_size = node.left.size if node.left else 0
+            if index < left_size:
+                node = node.left
+            elif index > left_size:
+                index -= left_size + 1
+                node = node.right
             else:
-                to_delete = self.get_min(node.right)
-                self._delete_leaf_parent(to_delete)
+                return self._key_of(node)
 
-    def get_height(self, *args):
-        if len(args) == 0:
-            node = self.root
-        else:
-            node = args[0]
+    def count_range(self, lo, hi):
+        """Returns the number of keys k with lo <= k <= hi"""
 
-        if not node or (not node.left and not node.right):
+        if self.key is not None:
+            lo, hi = self.key(lo), self.key(hi)
+        if hi < lo:
             return 0
-        else:
-            return 1 + max(self.get_height(node.left), self.get_height(node.right))
+        return self._count_less(hi, True) - self._count_less(lo, False)
+
+    def __iter__(self):
+        """Iterates over the keys in ascending order, following parent links instead of a stack"""
+
+        node = self._leftmost(self.root)
+        if self.key is not None:
+            while node:
+                yield node.item
+                node = self._next_node(node)
+            return
+        while node:
+            yield node.key
+            node = self._next_node(node)
+
+    def __reversed__(self):
+        node = self._rightmost(self.root)
+        if self.key is not None:
+            while node:
+                yield node.item
+                node = self._prev_node(node)
+            return
+        while node:
+            yield node.key
+            node = self._prev_node(node)
+
+    def _key_of(self, node):
+        """Returns the key of node as it was passed in"""
+
+        return node.key if self.key is None else node.item
+
+    def irange(self, lo=None, hi=None, inclusive=(True, True)):
+        """
+        Lazily iterates over the keys between lo and hi in ascending order.
+        None means no bound, inclusive is a pair of flags for lo and hi
+        """
 
-    def get_max(self, *args):
-        if len(args) == 0:
-            node = self.root
+        keyed = self.key is not None
+        if keyed:
+            lo = None if lo is None else self.key(lo)
+            hi = None if hi is None else self.key(hi)
+        if lo is None:
+            node = self._leftmost(self.root)
         else:
-            node = args[0]
+            node = self._ceiling_node(lo, inclusive[0])
 
-        if not node.right:
-            return node
+        if hi is None:
+            while node:
+                yield node.item if keyed else node.key
+                node = self._next_node(node)
         else:
-            return self.get_max(node.right)
+            include_hi = inclusive[1]
+            while node and (node.key < hi or (include_hi and node.key == hi)):
+                yield node.item if keyed else node.key
+                node = self._next_node(node)
+
+    def floor(self, key):
+        """Returns the greatest key less than or equal to key or None"""
+
+        if self.key is not None:
+            key = self.key(key)
+        node = self._floor_node(key, True)
+        return self._key_of(node) if node else None
+
+    def ceiling(self, key):
+        """Returns the least key greater than or equal to key or None"""
+
+        if self.key is not None:
+            key = self.key(key)
+        node = self._ceiling_node(key, True)
+        return self._key_of(node) if node else None
+
+    def successor(self, key):
+        """Returns the least key greater than key or None"""
+
+        if self.key is not None:
+            key = self.key(key)
+        node = self._ceiling_node(key, False)
+        return self._key_of(node) if node else None
+
+    def predecessor(self, key):
+        """Returns the greatest key less than key or None"""
+
+        if self.key is not None:
+            key = self.key(key)
+        node = self._floor_node(key, False)
+        return self._key_of(node) if node else None
+
+    def _ceiling_node(self, key, inclusive):
+        found = None
+        node = self.root
+        while node:
+            if key < node.key or (inclusive and key == node.key):
+                found = node
+                node = node.left
+            else:
+                node = node.right
+        return found
+
+    def _floor_node(self, key, inclusive):
+        found = None
+        node = self.root
+        while node:
+            if key > node.key or (inclusive and key == node.key):
+                found = node
+                node = node.right
+            else:
+                node = node.left
+        return found
 
-    def get_min(self, *args):
-        if len(args) == 0:
-            node = self.root
-        else:
-            node = args[0]
+    @staticmethod
+    def _leftmost(node):
+        if node:
+            while node.left:
+                node = node.left
+        return node
 
-        if not node.left:
-            return node
-        else:
-            return self.get_min(node.left)
+    @staticmethod
+    def _rightmost(node):
+        if node:
+            while node.right:
+                node = node.right
+        return node
 
-    def _switch_nodes(self, node1, node2):
-        switch1 = node1
-        switch2 = node2
-        temp_key = switch1.key
+    def _next_node(self, node):
+        """Returns the in-order successor of node"""
 
-        if switch1.key == self.root.key:
-            self.root.key = node2.key
-            switch2.key = temp_key
+        if node.right:
+            return self._leftmost(node.right)
+        parent = node.parent
+        while parent and node is parent.right:
+            node = parent
+            parent = parent.parent
+        return parent
 
-        elif switch2.key == self.root.key:
-            switch1.key = self.root.key
-            self.root.key = temp_key
-        else:
-            switch1.key = node2.key
-            switch2.key = temp_key
+    def _prev_node(self, node):
+        """Returns the in-order predecessor of node"""
 
-    def _delete_leaf_parent(self, node):
-        par_node = node.parent
-        node_color = node.color
         if node.left:
-            child_color = node.left.color
-        else:
-            child_color = node.right.color
+            return self._rightmost(node.left)
+        parent = node.parent
+        while parent and node is parent.left:
+            node = parent
+            parent = parent.parent
+        return parent
 
-        if node.key == self.root.key:
-            if node.right:
-                self.root = node.right
-                self.root.color = 'k'
-                node.right = None
-                new_node = node.right
+    def delete(self, key):
+        """
+        Deletes a node by key. Returns True if the key was in the tree.
+        A node with two children takes the key and value of its in-order successor,
+        which is then unlinked instead: the unlinked node has at most one child
+        """
+
+        if self.key is not None:
+            key = self.key(key)
+        return self._delete(key)
+
+    def _delete(self, key):
+        """delete for a key that is already mapped by the key function"""
+
+        node = self._get_node(key)
+        if not node:
+            return False
+
+        record = None if self._log is None else self._log.pack('delete', (key,))
+        if node.left and node.right:
+            successor = self._leftmost(node.right)
+            node.key = successor.key
+            node.value = successor.value
+            if self.key is not None:
+                node.item = successor.item
+            node = successor
+
+        child = node.left if node.left else node.right
+        parent = node.parent
+        self._shrink_path(parent)
+
+        if child:
+            child.parent = parent
+        if parent is None:
+            self.root = child
+        elif parent.left is node:
+            parent.left = child
+        else:
+            parent.right = child
+
+        node.left = node.right = node.parent = None
+        if node.color == BLACK:
+            if child and child.color == RED:
+                child.color = BLACK
+                if self._stats is not None:
+                    self._stats.recolors += 1
             else:
-                self.root = node.left
-                self.root.color = 'k'
-                node.left = None
-                new_node = node.left
+                self._delete_case_one(child, parent)
+        if record is not None:
+            self._log.write(record)
+        return True
+
+    def insert_many(self, iterable):
+        """
+        Inserts keys from iterable, returns the number of keys added.
+        The batch is sorted first. A batch that is dense among the keys of the tree is walked
+        together with the tree, see _insert_nodes, a sparse one is inserted key by key.
+        When it is large compared to the tree, the tree is rebuilt from a merge
+        of its nodes and the batch instead
+        """
 
+        nodes = None
+        if self.key is None:
+            batch = self._unique(sorted(iterable))
         else:
-            if par_node.right == node:
-                if node.right:
-                    par_node.right = node.right
-                    par_node.right.parent = par_node
-                    node.right = None
-                    if node_color == 'k' and child_color == 'r':
-                        par_node.right.color = 'k'
+            # the nodes carry the keys as passed in, the batch is their cached key(k)
+            with _gc_paused():
+                nodes = self._nodes_from_sorted(sorted(iterable, key=self.key), self.key)
+            batch = [node.key for node in nodes]
+        if not batch:
+            return 0
 
+        size = len(self)
+        record = None if self._log is None else self._log.pack('insert', batch)
+        log, self._log = self._log, None
+        try:
+            with _gc_paused():
+                if self._should_rebuild(len(batch), size):
+                    self.root = self._link_sorted(self._merge_nodes(nodes or self._nodes_from_sorted(batch)))
+                elif nodes is not None or self._is_dense(batch):
+                    self._insert_nodes(nodes or self._nodes_from_sorted(batch))
                 else:
-                    par_node.right = node.left
-                    par_node.right.parent = par_node
-                    node.left = None
-                    if node_color == 'k' and child_color == 'r':
-                        par_node.right.color = 'k'
+                    for key in batch:
+                        self._insert(key)
+        finally:
+            self._log = log
+        if record is not None:
+            log.write(record)
+        return len(self) - size
+
+    def _is_dense(self, batch):
+        """
+        Tells if there are at most 4 keys of the tree between neighbouring keys of the sorted batch.
+        Only then the short climbs of _insert_nodes and its size pass beat a full descent per key,
+        on a million keys batches spread wider run up to twice as slow
+        """
 
-                new_node = par_node.right
+        count = self._count_less(batch[-1], True) - self._count_less(batch[0], False)
+        return count <= 4 * len(batch)
 
-            else:
+    def _insert_nodes(self, nodes):
+        """
+        Inserts new nodes sorted by key, skipping the keys already in the tree.
+        The search for a key starts at the lowest ancestor of the previous node whose key range
+        covers it instead of at the root, so close keys cost a short climb and descent.
+        Sizes are left alone during the walk and fixed on the paths to the new nodes at the end.
+        Returns the number of nodes added
+        """
 
-                if node.right:
-                    par_node.left = node.right
-                    par_node.left.parent = par_node
-                    node.right = None
-                    if node_color == 'k' and child_color == 'r':
-                        par_node.left.color = 'k'
+        added = []
+        try:
+            self._walk_in(nodes, added)
+        finally:
+            # also after a key that does not compare with the keys in the tree
+            self._fix_sizes(added)
+        return len(added)
+
+    def _walk_in(self, nodes, added):
+        """The walk of _insert_nodes, appends every node it links to added"""
+
+        finger = None
+        for child in nodes:
+            key = child.key
+            if finger is None:
+                parent = self.root
+                if not parent:
+                    self.root = child
+                    child.color = BLACK
+                    added.append(child)
+                    finger = child
+                    continue
+            else:
+                # climb until the range of parent ends above key:
+                # parent is a left child and key is less than its parent
+                parent = finger
+                up = parent.parent
+                while up and (parent is up.right or not key < up.key):
+                    parent = up
+                    up = up.parent
+
+            while True:
+                if key > parent.key:
+                    if not parent.right:
+                        parent.right = child
+                        break
+                    parent = parent.right
+                elif key < parent.key:
+                    if not parent.left:
+                        parent.left = child
+                        break
+                    parent = parent.left
                 else:
-                    par_node.left = node.left
-                    par_node.left.parent = par_node
-                    node.left = None
-                    if node_color == 'k' and child_color == 'r':
-                        par_node.left.color = 'k'
+                    child = None
+                    break
+
+            if child is None:
+                finger = parent
+                continue
+            child.parent = parent
+            if parent.color == RED:
+                self._insert_case_one(child)
+            added.append(child)
+            finger = child
+
+    def _fix_sizes(self, nodes):
+        """
+        Recomputes the sizes of nodes and all their ancestors, children first.
+        Rotations keep the size of every node without a new node below it right,
+        so only these paths can be stale. They are marked with size 0 first
+        """
 
-                new_node = par_node.left
+        for node in nodes:
+            while node and node.size:
+                node.size = 0
+                node = node.parent
 
-        del node
+        order = [self.root] if self.root and not self.root.size else []
+        for node in order:
+            if node.left and not node.left.size:
+                order.append(node.left)
+            if node.right and not node.right.size:
+                order.append(node.right)
+        for node in reversed(order):
+            node.size = 1 + (node.left.size if node.left else 0) + (node.right.size if node.right else 0)
 
-        if node_color == 'k' and child_color == 'k':
-            self._delete_case_one(new_node, par_node)
+    def update(self, *iterables):
+        """Inserts keys from every iterable, returns the number of keys added"""
 
-    def _delete_leaf(self, node):
-        par_node = node.parent
-        node_color = node.color
-        new_node = None
+        return sum(self.insert_many(iterable) for iterable in iterables)
 
-        if par_node:
-            if par_node.left == node:
-                par_node.left = None
-                new_node = None
-            else:
-                par_node.right = None
-                new_node = None
+    def delete_many(self, iterable):
+        """
+        Deletes keys from iterable, returns the number of keys removed.
+        A batch too small for a rebuild is deleted key by key. A larger one is looked up
+        in one walk first and, like insert_many, the tree is rebuilt without the keys found
+        when there are many compared to the tree
+        """
 
-            del node
+        batch = self._unique(sorted(iterable if self.key is None else map(self.key, iterable)))
+        size = len(self)
+        if not self._should_rebuild(len(batch), size):
+            # every delete packs and writes its own record
+            return sum(self._delete(key) for key in batch)
+
+        present = [node for node in self._find_sorted(batch) if node]
+        if not self._should_rebuild(len(present), size):
+            keys = [node.key for node in present]
+            return sum(self._delete(key) for key in keys)
+
+        record = None if self._log is None else self._log.pack('delete', [node.key for node in present])
+        present = set(present)
+        nodes = [node for node in self._iter_nodes() if node not in present]
+        with _gc_paused():
+            self.root = self._link_sorted(nodes)
+        if record is not None:
+            self._log.write(record)
+        return size - len(self)
+
+    @staticmethod
+    def _should_rebuild(batch_size, tree_size):
+        """
+        Relinking a node costs about a fifth of a fixed-up insert or delete,
+        so a rebuild pays off once the batch is about a quarter of the tree
+        """
 
-        new_parent = par_node
+        return batch_size * 4 >= tree_size
+
+    def _iter_nodes(self):
+        node = self._leftmost(self.root)
+        while node:
+            yield node
+            node = self._next_node(node)
+
+    def _merge_nodes(self, new_nodes):
+        """Merges the nodes of the tree with new nodes sorted by key, skipping keys already in the tree"""
+
+        count = len(new_nodes)
+        merged = []
+        append = merged.append
+        i = 0
+        for node in self._iter_nodes():
+            while i < count and new_nodes[i].key < node.key:
+                append(new_nodes[i])
+                i += 1
+            if i < count and new_nodes[i].key == node.key:
+                i += 1
+            append(node)
+        merged.extend(new_nodes[i:])
+        return merged
+
+    def copy(self):
+        """Returns a copy of the tree with the same shape, in linear time"""
+
+        nodes = list(self._iter_preorder())
+        tree = self.__class__(key=self.key)
+        with _gc_paused():
+            tree.root = self._link_preorder([node.key for node in nodes], [node.color for node in nodes],
+                                            [node.value for node in nodes],
+                                            None if self.key is None else [node.item for node in nodes])
+        return tree
+
+    @classmethod
+    def join(cls, left, key, right, value=None):
+        """
+        Joins two trees and a key between them, mapped to value, into a new tree in O(log n).
+        Every key of left must be less than key and every key of right greater.
+        The nodes are moved: left and right are left empty
+        """
 
-        if node_color == 'k':
-            self._delete_case_one(new_node, new_parent)
+        mid = Node(key, value) if left.key is None else KeyedNode(left.key(key), key, value)
+        if (left.root and not left.get_max().key < mid.key) or (right.root and not mid.key < right.get_min().key):
+            raise ValueError("left keys must be less than " + str(key) + " and right keys greater")
+
+        tree = cls(key=left.key)
+        left_root, right_root = left.root, right.root
+        left.root = right.root = None
+        for part in (left, right):
+            if part._log is not None:
+                part._log.write(part._log.pack('clear', ()))
+        root, _ = tree._join(left_root, tree._black_height(left_root), mid,
+                             right_root, tree._black_height(right_root))
+        tree.root = root
+        return tree
+
+    def split(self, key):
+        """
+        Splits the tree in O(log n) into a tree of the keys less than key and a tree of the keys greater.
+        The nodes are moved: this tree is left empty.
+        Returns (left, found, right), found is the detached node of key with its value
+        (and its key as passed in with a key function) or None if key was not in the tree.
+        RBTree.join(left, found.key, right, found.value) puts the tree back together
+        """
 
-    def _delete_case_one(self, child, parent):
-        if parent:
-            self._delete_case_two(child, parent)
+        if self.key is not None:
+            key = self.key(key)
+        left, _, found, right, _ = self._split(self.root, self._black_height(self.root), key)
+        self.root = None
+        if self._log is not None:
+            self._log.write(self._log.pack('clear', ()))
+        return self._wrap(left), found, self._wrap(right)
 
-    def _delete_case_two(self, child, parent):
-        node = child
-        par_node = parent
-        sib_node = None
-
-        if par_node.left == node:
-            sib_node = par_node.right
-        elif par_node.right == node:
-            sib_node = par_node.left
-
-        if sib_node and sib_node.color == 'r':
-            sib_node.color = 'k'
-            par_node.color = 'r'
-            if par_node.left == node:
-                self._rotate_left(par_node)
-            else:
-                self._rotate_right(par_node)
+    def union(self, other):
+        """Returns a new tree with the keys of both trees"""
 
-        self._delete_case_three(node, par_node)
+        tree = self.copy()
+        tree |= other if isinstance(other, RBTree) else RBTree(other, self.key)
+        return tree
 
-    def _delete_case_three(self, child, parent):
-        node = child
-        par_node = parent
-        sib_node = None
+    def intersection(self, other):
+        """Returns a new tree with the keys that are in both trees"""
 
-        if par_node.left == node:
-            sib_node = par_node.right
-        elif par_node.right == node:
-            sib_node = par_node.left
+        tree = self.copy()
+        tree &= other if isinstance(other, RBTree) else RBTree(other, self.key)
+        return tree
 
-        if (sib_node and sib_node.color == 'k') or (not sib_node):
-            sib_color = 'k'
-        else:
-            sib_color = 'r'
+    def difference(self, other):
+        """Returns a new tree with the keys of this tree that are not in other"""
 
-        if (sib_node and sib_node.left and sib_node.left.color == 'k') or (not sib_node or not sib_node.left):
-            sib_left_color = 'k'
-        else:
-            sib_left_color = 'r'
+        tree = self.copy()
+        tree -= other if isinstance(other, RBTree) else RBTree(other, self.key)
+        return tree
 
-        if (sib_node and sib_node.right and sib_node.right.color == 'k') or (not sib_node or not sib_node.right):
-            sib_right_color = 'k'
-        else:
-            sib_right_color = 'r'
+    def __or__(self, other):
+        if not isinstance(other, RBTree):
+            return NotImplemented
+        return self.union(other)
 
-        if par_node.color == 'k' and sib_color == 'k' and sib_left_color == 'k' and sib_right_color == 'k':
-            if sib_node:
-                sib_node.color = 'r'
-            self._delete_case_one(par_node, par_node.parent if par_node.parent else None)
-        else:
-            self._delete_case_four(node, par_node)
+    def __and__(self, other):
+        if not isinstance(other, RBTree):
+            return NotImplemented
+        return self.intersection(other)
 
-    def _delete_case_four(self, child, parent):
-        node = child
-        par_node = parent
-        sib_node = None
+    def __sub__(self, other):
+        if not isinstance(other, RBTree):
+            return NotImplemented
+        return self.difference(other)
 
-        if par_node.left == node:
-            sib_node = par_node.right
-        elif par_node.right == node:
-            sib_node = par_node.left
+    def __ior__(self, other):
+        """
+        In place union. Splits the bigger tree by the keys of the smaller one:
+        O(m log(n/m + 1)) for sizes m <= n, plus copying the nodes of other
+        """
 
-        if (sib_node and sib_node.color == 'k') or (not sib_node):
-            sib_color = 'k'
-        else:
-            sib_color = 'r'
+        if not isinstance(other, RBTree):
+            return NotImplemented
+        if other is self or not other.root:
+            return self
+
+        record = None if self._log is None else self._log.pack('insert', list(other), other.values())
+        # like dict.update, the values of other win and the keys of this tree stay
+        small, big = other.copy().root, self.root
+        take_values = False
+        if len(self) < len(other):
+            small, big = big, small
+            take_values = True
+        self.root = None
+        root, _ = self._union(small, self._black_height(small), big, self._black_height(big), take_values)
+        self.root = self._wrap_root(root)
+        if record is not None:
+            self._log.write(record)
+        return self
+
+    def __iand__(self, other):
+        """In place intersection. Splits this tree by the keys of other, other is only read"""
+
+        if not isinstance(other, RBTree):
+            return NotImplemented
+        if other is self:
+            return self
+
+        record = None if self._log is None else self._log.pack('retain', list(other))
+        root = self.root
+        self.root = None
+        root, _ = self._intersection(root, self._black_height(root), other.root)
+        self.root = self._wrap_root(root)
+        if record is not None:
+            self._log.write(record)
+        return self
+
+    def __isub__(self, other):
+        """In place difference. Splits this tree by the keys of other, other is only read"""
+
+        if not isinstance(other, RBTree):
+            return NotImplemented
+
+        record = None
+        if self._log is not None:
+            record = self._log.pack('clear', ()) if other is self else self._log.pack('delete', list(other))
+        root = self.root
+        self.root = None
+        if other is not self:
+            root, _ = self._difference(root, self._black_height(root), other.root)
+            self.root = self._wrap_root(root)
+        if record is not None:
+            self._log.write(record)
+        return self
+
+    def _wrap(self, root):
+        tree = self.__class__(key=self.key)
+        tree.root = self._wrap_root(root)
+        return tree
+
+    @staticmethod
+    def _wrap_root(root):
+        """Makes a detached subtree a valid tree root: no parent and black"""
+
+        if root:
+            root.parent = None
+            root.color = BLACK
+        return root
+
+    @staticmethod
+    def _black_height(node):
+        """Returns the number of black nodes on a path from node down to a leaf, node included"""
+
+        height = 0
+        while node:
+            if node.color == BLACK:
+                height += 1
+            node = node.left
+        return height
+
+    def _join(self, left, left_bh, mid, right, right_bh):
+        """
+        Joins two detached subtrees with black heights left_bh and right_bh
+        and a detached node whose key lies between them, in O(|left_bh - right_bh| + 1).
+        The taller subtree is descended along its inner spine to a black node as high as
+        the other subtree, where mid is attached red and fixed up like an insert.
+        Uses self.root for the fix-up. Returns the new root and its black height
+        """
 
-        if (sib_node and sib_node.left and sib_node.left.color == 'k') or (not sib_node or not sib_node.left):
-            sib_left_color = 'k'
+        if left:
+            left.parent = None
+            if left.color == RED:
+                left.color = BLACK
+                left_bh += 1
+        if right:
+            right.parent = None
+            if right.color == RED:
+                right.color = BLACK
+                right_bh += 1
+
+        if left_bh == right_bh:
+            mid.left, mid.right, mid.parent = left, right, None
+            mid.color = BLACK
+            mid.size = 1 + (left.size if left else 0) + (right.size if right else 0)
+            if left:
+                left.parent = mid
+            if right:
+                right.parent = mid
+            return mid, left_bh + 1
+
+        if left_bh > right_bh:
+            top, height, target, other = left, left_bh, right_bh, right
         else:
-            sib_left_color = 'r'
-
-        if ((sib_node and sib_node.right and sib_node.right.color == 'k') or (not sib_node or not sib_node.right)):
-            sib_right_color = 'k'
+            top, height, target, other = right, right_bh, left_bh, left
+        extra = 1 + (other.size if other else 0)
+
+        parent = None
+        node = top
+        while not (height == target and (node is None or node.color == BLACK)):
+            node.size += extra
+            if node.color == BLACK:
+                height -= 1
+            parent = node
+            node = node.right if top is left else node.left
+
+        if top is left:
+            mid.left, mid.right = node, right
+            parent.right = mid
         else:
-            sib_right_color = 'r'
+            mid.left, mid.right = left, node
+            parent.left = mid
+        mid.parent = parent
+        mid.color = RED
+        mid.size = 1 + (mid.left.size if mid.left else 0) + (mid.right.size if mid.right else 0)
+        if mid.left:
+            mid.left.parent = mid
+        if mid.right:
+            mid.right.parent = mid
+
+        self.root = top
+        if self._stats is not None:
+            self._stats.fixup = 'join'
+        grew = self._insert_case_one(mid)
+        if self._stats is not None:
+            self._stats.fixup = 'insert'
+        return self.root, max(left_bh, right_bh) + grew
+
+    def _join_two(self, left, left_bh, right, right_bh):
+        """Joins two detached subtrees without a middle node: the greatest key of left becomes it"""
+
+        if not left:
+            return right, right_bh
+        left, left_bh, mid, _, _ = self._split(left, left_bh, self._rightmost(left).key)
+        return self._join(left, left_bh, mid, right, right_bh)
+
+    def _split(self, root, root_bh, key):
+        """
+        Splits a detached subtree by key: walks down to key and joins the subtrees
+        hanging off the path on the way back up.
+        Returns (left, left_bh, found, right, right_bh), found is the detached node with key or None
+        """
 
-        if par_node.color == 'r' and sib_color == 'k' and sib_left_color == 'k' and sib_right_color == 'k':
-            sib_node.color = 'r'
-            par_node.color = 'k'
+        path = []
+        node = root
+        height = root_bh
+        while node and node.key != key:
+            path.append((node, height))
+            height -= node.color == BLACK
+            node = node.left if key < node.key else node.right
+
+        found = node
+        left = right = None
+        left_bh = right_bh = 0
+        if found:
+            left_bh = right_bh = height - (found.color == BLACK)
+            left, right = found.left, found.right
+            found.left = found.right = found.parent = None
+            found.size = 1
+
+        for node, height in reversed(path):
+            child_bh = height - (node.color == BLACK)
+            if key < node.key:
+                child = node.right
+                node.left = node.right = None
+                right, right_bh = self._join(right, right_bh, node, child, child_bh)
+            else:
+                child = node.left
+                node.left = node.right = None
+                left, left_bh = self._join(child, child_bh, node, left, left_bh)
+
+        return left, left_bh, found, right, right_bh
+
+    def _union(self, small, small_bh, big, big_bh, take_values=False):
+        """
+        Union of two detached subtrees, splits big by the keys of small. Keeps the nodes of small,
+        with take_values a node of small gets the value of the node of big with the same key,
+        otherwise its key as passed in
+        """
+
+        if not small:
+            return big, big_bh
+        if not big:
+            return small, small_bh
+
+        child_bh = small_bh - (small.color == BLACK)
+        small_left, small_right = small.left, small.right
+        small.left = small.right = None
+        big_left, big_left_bh, found, big_right, big_right_bh = self._split(big, big_bh, small.key)
+        if found and take_values:
+            small.value = found.value
+        elif found:
+            small.key = found.key
+            if self.key is not None:
+                small.item = found.item
+
+        left, left_bh = self._union(small_left, child_bh, big_left, big_left_bh, take_values)
+        right, right_bh = self._union(small_right, child_bh, big_right, big_right_bh, take_values)
+        return self._join(left, left_bh, small, right, right_bh)
+
+    def _intersection(self, root, root_bh, other):
+        """Intersection of a detached subtree with the subtree of other, which is only read"""
+
+        if not root or not other:
+            return None, 0
+
+        left, left_bh, found, right, right_bh = self._split(root, root_bh, other.key)
+        left, left_bh = self._intersection(left, left_bh, other.left)
+        right, right_bh = self._intersection(right, right_bh, other.right)
+        if found:
+            return self._join(left, left_bh, found, right, right_bh)
+        return self._join_two(left, left_bh, right, right_bh)
+
+    def _difference(self, root, root_bh, other):
+        """Difference of a detached subtree and the subtree of other, which is only read"""
+
+        if not root:
+            return None, 0
+        if not other:
+            return root, root_bh
+
+        left, left_bh, _, right, right_bh = self._split(root, root_bh, other.key)
+        left, left_bh = self._difference(left, left_bh, other.left)
+        right, right_bh = self._difference(right, right_bh, other.right)
+        return self._join_two(left, left_bh, right, right_bh)
+
+    def get_height(self, *args):
+        if len(args) == 0:
+            node = self.root
         else:
-            self._delete_case_five(node, par_node)
+            node = args[0]
 
-    def _delete_case_five(self, child, parent):
-        node = child
-        par_node = parent
-        sib_node = None
+        if not node:
+            return 0
 
-        if par_node.left == node:
-            sib_node = par_node.right
-        elif par_node.right == node:
-            sib_node = par_node.left
+        height = 0
+        stack = [(node, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth > height:
+                height = depth
+            if node.left:
+                stack.append((node.left, depth + 1))
+            if node.right:
+                stack.append((node.right, depth + 1))
+        return height
 
-        if (sib_node and sib_node.color == 'k') or (not sib_node):
-            sib_color = 'k'
+    def get_max(self, *args):
+        if len(args) == 0:
+            node = self.root
         else:
-            sib_color = 'r'
+            node = args[0]
 
-        if (sib_node and sib_node.left and sib_node.left.color == 'k') or (not sib_node or not sib_node.left):
-            sib_left_color = 'k'
+        return self._rightmost(node)
+
+    def get_min(self, *args):
+        if len(args) == 0:
+            node = self.root
         else:
-            sib_left_color = 'r'
+            node = args[0]
+
+        return self._leftmost(node)
+
+    def _iter_preorder(self):
+        """Iterates over the nodes in preorder with an explicit stack"""
+
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.right:
+                stack.append(node.right)
+            if node.left:
+                stack.append(node.left)
+
+    def __getstate__(self):
+        """
+        Pickles the tree as flat lists of keys, colors, values and keys as passed in in preorder,
+        so pickle never recurses through the linked nodes. Without values or a key function
+        their lists are left out
+        """
+
+        state = self.__dict__.copy()
+        # the log and the metrics with their per-instance method wrappers stay behind
+        for name in ('_log', '_stats', 'insert', 'delete', 'get_node', 'find_many'):
+            state.pop(name, None)
+        nodes = list(self._iter_preorder())
+        values = [node.value for node in nodes]
+        if not any(value is not None for value in values):
+            values = None
+        items = None if self.key is None else [node.item for node in nodes]
+        state['root'] = ([node.key for node in nodes], bytes([node.color for node in nodes]), values, items)
+        return state
+
+    def __setstate__(self, state):
+        keys, colors, values, items = state['root']
+        self.__dict__.update(state)
+        with _gc_paused():
+            self.root = self._link_preorder(keys, colors, values, items)
+
+    @staticmethod
+    def _link_preorder(keys, colors, values=None, items=None):
+        """
+        Rebuilds the exact shape of a tree from its keys, colors and values in preorder.
+        With items, the keys as passed in to a tree with a key function, it is made of KeyedNodes
+        """
 
-        if (sib_node and sib_node.right and sib_node.right.color == 'k') or (not sib_node or not sib_node.right):
-            sib_right_color = 'k'
+        if not keys:
+            return None
+
+        if items is not None:
+            nodes = [KeyedNode(key, item, value) for key, item, value in zip(keys, items, values or [None] * len(keys))]
+        elif values is None:
+            nodes = [Node(key) for key in keys]
         else:
-            sib_right_color = 'r'
+            nodes = [Node(key, value) for key, value in zip(keys, values)]
+        root = nodes[0]
+        root.color = colors[0]
+        stack = [root]
+        for i in range(1, len(nodes)):
+            node = nodes[i]
+            node.color = colors[i]
+            parent = None
+            while stack and stack[-1].key < node.key:
+                parent = stack.pop()
+            if parent:
+                parent.right = node
+            else:
+                parent = stack[-1]
+                parent.left = node
+            node.parent = parent
+            stack.append(node)
 
-        if sib_color == 'k':
+        # children follow their parents in preorder
+        for node in reversed(nodes):
+            if node.parent:
+                node.parent.size += node.size
+        return root
 
-            if par_node.left == node and sib_right_color == 'k' and sib_left_color == 'r':
-                sib_node.color = 'r'
-                sib_node.left.color = 'k'
-                self._rotate_right(sib_node)
-            elif par_node.right == node and sib_left_color == 'k' and sib_right_color == 'r':
-                sib_node.color = 'r'
-                sib_node.right.color = 'k'
-                self._rotate_left(sib_node)
+    def _sibling(self, child, parent):
+        """Returns the other child of parent. child may be None, then it is the missing one"""
 
-        self._delete_case_six(node, par_node)
+        if parent.left is child:
+            return parent.right
+        return parent.left
 
-    def _delete_case_six(self, child, parent):
-        node = child
-        par_node = parent
-        sib_node = None
+    @staticmethod
+    def _is_black(node):
+        return node is None or node.color == BLACK
 
-        if par_node.left == node:
-            sib_node = par_node.right
-        elif par_node.right == node:
-            sib_node = par_node.left
+    def _delete_case_one(self, child, parent):
+        """
+        child is one black node short on its paths.
+        If it is the root, the whole tree lost one black level - ok,
+        else goes into the second case
+        """
+        if self._stats is not None:
+            self._stats.hit('delete_case_one')
+        if parent:
+            self._delete_case_two(child, parent)
 
-        if (sib_node and sib_node.color == 'k') or (not sib_node):
-            sib_color = 'k'
+    def _delete_case_two(self, child, parent):
+        """
+        If the sibling is red, recolors it black and the parent red
+        and rotates around the parent, so the sibling becomes black.
+        Then goes into the third case
+        """
+        if self._stats is not None:
+            self._stats.hit('delete_case_two')
+        sib_node = self._sibling(child, parent)
+
+        if sib_node.color == RED:
+            sib_node.color = BLACK
+            parent.color = RED
+            if self._stats is not None:
+                self._stats.recolors += 2
+            if parent.left is child:
+                self._rotate_left(parent)
+            else:
+                self._rotate_right(parent)
+
+        self._delete_case_three(child, parent)
+
+    def _delete_case_three(self, child, parent):
+        """
+        If the parent, the sibling and the sibling's children are black,
+        recolors the sibling red and starts again from the first case on the parent.
+        Otherwise goes into the fourth case
+        """
+        if self._stats is not None:
+            self._stats.hit('delete_case_three')
+        sib_node = self._sibling(child, parent)
+
+        if parent.color == BLACK and sib_node.color == BLACK and \
+                self._is_black(sib_node.left) and self._is_black(sib_node.right):
+            sib_node.color = RED
+            if self._stats is not None:
+                self._stats.recolors += 1
+            self._delete_case_one(parent, parent.parent)
         else:
-            sib_color = 'r'
+            self._delete_case_four(child, parent)
 
-        if (sib_node and sib_node.left and sib_node.left.color == 'k') or (not sib_node or not sib_node.left):
-            sib_left_color = 'k'
+    def _delete_case_four(self, child, parent):
+        """
+        If the parent is red and the sibling and its children are black,
+        swaps the colors of the parent and the sibling - done.
+        Otherwise goes into the fifth case
+        """
+        if self._stats is not None:
+            self._stats.hit('delete_case_four')
+        sib_node = self._sibling(child, parent)
+
+        if parent.color == RED and sib_node.color == BLACK and \
+                self._is_black(sib_node.left) and self._is_black(sib_node.right):
+            sib_node.color = RED
+            parent.color = BLACK
+            if self._stats is not None:
+                self._stats.recolors += 2
         else:
-            sib_left_color = 'r'
+            self._delete_case_five(child, parent)
+
+    def _delete_case_five(self, child, parent):
+        """
+        If the sibling is black, its near child is red and its far child is black,
+        rotates around the sibling so the red child becomes the far one.
+        Then goes into the sixth case
+        """
+        if self._stats is not None:
+            self._stats.hit('delete_case_five')
+        sib_node = self._sibling(child, parent)
+
+        if sib_node.color == BLACK:
+            if parent.left is child and self._is_black(sib_node.right) and not self._is_black(sib_node.left):
+                sib_node.color = RED
+                sib_node.left.color = BLACK
+                self._rotate_right(sib_node)
+                if self._stats is not None:
+                    self._stats.recolors += 2
+            elif parent.right is child and self._is_black(sib_node.left) and not self._is_black(sib_node.right):
+                sib_node.color = RED
+                sib_node.right.color = BLACK
+                self._rotate_left(sib_node)
+                if self._stats is not None:
+                    self._stats.recolors += 2
+
+        self._delete_case_six(child, parent)
 
-        if (sib_node and sib_node.right and sib_node.right.color == 'k') or (not sib_node or not sib_node.right):
-            sib_right_color = 'k'
+    def _delete_case_six(self, child, parent):
+        """
+        The sibling is black and its far child is red:
+        rotates around the parent, so the sibling takes the parent's place and color
+        and the parent and the far child become black
+        """
+        if self._stats is not None:
+            self._stats.hit('delete_case_six')
+        sib_node = self._sibling(child, parent)
+
+        sib_node.color = parent.color
+        parent.color = BLACK
+        if parent.left is child:
+            sib_node.right.color = BLACK
+            self._rotate_left(parent)
         else:
-            sib_right_color = 'r'
-
-        if par_node.left == node and sib_color == 'k' and sib_right_color == 'r':
-            sib_node.color = par_node.color
-            par_node.color = 'k'
-            sib_node.right.color = 'k'
-            self._rotate_left(par_node)
-        elif par_node.right == node and sib_color == 'k' and sib_left_color == 'r':
-            sib_node.color = par_node.color
-            par_node.color = 'k'
-            sib_node.left.color = 'k'
-            self._rotate_right(par_node)
+            sib_node.left.color = BLACK
+            self._rotate_right(parent)
+        if self._stats is not None:
+            self._stats.recolors += 3
+
+    def validate(self):
+        """
+        Checks the tree invariants: BST order, parent links, subtree sizes,
+        a black root, no red node with a red child and equal black heights.
+        Raises ValueError on the first violation, returns the black height otherwise
+        """
+
+        root = self.root
+        if not root:
+            return 0
+        if root.parent is not None:
+            raise ValueError("the root has a parent")
+        if root.color != BLACK:
+            raise ValueError("the root is red")
+
+        black_heights = {}
+        # nodes with their exclusive key bounds, children are checked after the parent
+        stack = [(root, None, None, False)]
+        while stack:
+            node, lo, hi, visited = stack.pop()
+            left = node.left
+            right = node.right
+            if visited:
+                left_height = black_heights.pop(id(left)) if left else 0
+                right_height = black_heights.pop(id(right)) if right else 0
+                if left_height != right_height:
+                    raise ValueError("black heights differ under " + str(node.key))
+                size = 1 + (left.size if left else 0) + (right.size if right else 0)
+                if node.size != size:
+                    raise ValueError("wrong size at " + str(node.key))
+                black_heights[id(node)] = left_height + (node.color == BLACK)
+                continue
+
+            if (lo is not None and not lo.key < node.key) or (hi is not None and not node.key < hi.key):
+                raise ValueError("keys are out of order at " + str(node.key))
+            if node.color not in (RED, BLACK):
+                raise ValueError("unknown color at " + str(node.key))
+            stack.append((node, lo, hi, True))
+            for child, child_lo, child_hi in ((left, lo, node), (right, node, hi)):
+                if child:
+                    if child.parent is not node:
+                        raise ValueError("broken parent link at " + str(child.key))
+                    if node.color == RED and child.color == RED:
+                        raise ValueError("red node " + str(node.key) + " has a red child")
+                    stack.append((child, child_lo, child_hi, False))
+
+        return black_heights[id(root)]
@@ -0,0 +1,308 @@
+"""
+Binary .rbtree snapshots.
+
+Layout, little-endian:
+    header   32 bytes: magic, format version, layout, key format, key count, padding
+    keys     count int64 keys in ascending order
+
+The only layout so far is LAYOUT_BALANCED: the tree is the one RBTree.from_sorted
+builds from the keys, the middle key of every range is the root of its subtree.
+Its colors follow from the depth of a node, so they are not stored.
+Saving streams the keys in chunks, loading rebuilds the tree in linear time without fix-ups.
+SnapshotView searches a snapshot in place through mmap without loading it
+"""
+import array
+import bisect
+import itertools
+import mmap
+import os
+import struct
+import sys
+
+from rbtree import RBTree, BLACK, RED
+
+MAGIC = b'RBTREE\r\n'
+VERSION = 1
+LAYOUT_BALANCED = 0
+KEY_FORMAT = b'<q\0\0'
+
+HEADER = struct.Struct('<8sHH4sQ8x')
+CHUNK = 1 << 16
+
+
+class SnapshotError(ValueError):
+    """The file is not a valid .rbtree snapshot"""
+
+
+def _open(file, mode):
+    if hasattr(file, 'read' if 'r' in mode else 'write'):
+        return file, False
+    return open(file, mode), True
+
+
+def dump(tree, file):
+    """
+    Writes tree to a path or a binary file object. Keys must be ints that fit into int64
+    and keys mapped to a value other than None can't be saved, SnapshotError is raised
+    otherwise. The key function is not saved. A path is written to path + '.tmp' first
+    and replaced only once the whole snapshot is on disk, so a failed dump keeps the old file
+    """
+
+    if hasattr(file, 'write'):
+        _write(tree, file)
+        return
+    temp_path = file + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            _write(tree, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _write(tree, f):
+    f.write(HEADER.pack(MAGIC, VERSION, LAYOUT_BALANCED, KEY_FORMAT, len(tree)))
+    keys = _keys_without_values(tree) if hasattr(tree, 'items') else iter(tree)
+    while True:
+        try:
+            chunk = array.array('q', itertools.islice(keys, CHUNK))
+        except (TypeError, OverflowError):
+            raise SnapshotError("snapshots only hold int64 keys")
+        if not chunk:
+            break
+        if sys.byteorder == 'big':
+            chunk.byteswap()
+        chunk.tofile(f)
+
+
+def _keys_without_values(tree):
+    for key, value in tree.items():
+        if value is not None:
+            raise SnapshotError("snapshots don't hold values, " + str(key) + " has one")
+        yield key
+
+
+def read_header(f):
+    """Reads and checks the header, returns the number of keys"""
+
+    data = f.read(HEADER.size)
+    if len(data) != HEADER.size:
+        raise SnapshotError("truncated header")
+    magic, version, layout, key_format, count = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise SnapshotError("not an .rbtree snapshot")
+    if version != VERSION:
+        raise SnapshotError("unsupported snapshot version " + str(version))
+    if layout != LAYOUT_BALANCED or key_format != KEY_FORMAT:
+        raise SnapshotError("unsupported snapshot layout")
+    return count
+
+
+def load(file, cls=RBTree):
+    """Reads a tree of cls from a path or a binary file object"""
+
+    f, owned = _open(file, 'rb')
+    try:
+        count = read_header(f)
+        keys = array.array('q')
+        try:
+            keys.fromfile(f, count)
+        except EOFError:
+            raise SnapshotError("truncated keys")
+    finally:
+        if owned:
+            f.close()
+
+    if sys.byteorder == 'big':
+        keys.byteswap()
+    try:
+        return cls.from_sorted(keys)
+    except ValueError:
+        raise SnapshotError("keys are not sorted")
+
+
+class SnapshotNode:
+    """
+    A handle to a node of a SnapshotView: the range of key indexes of its subtree
+    and its depth. The key of the node is the middle one of the range
+    """
+
+    __slots__ = ('view', 'lo', 'hi', 'depth')
+
+    def __init__(self, view, lo, hi, depth):
+        self.view = view
+        self.lo = lo
+        self.hi = hi
+        self.depth = depth
+
+    @property
+    def index(self):
+        return (self.lo + self.hi) // 2
+
+    @property
+    def key(self):
+        return self.view._keys[self.index]
+
+    @property
+    def color(self):
+        return RED if self.depth and self.depth == self.view._red_depth else BLACK
+
+    @property
+    def size(self):
+        return self.hi - self.lo
+
+    @property
+    def left(self):
+        mid = self.index
+        return SnapshotNode(self.view, self.lo, mid, self.depth + 1) if self.lo < mid else None
+
+    @property
+    def right(self):
+        mid = self.index
+        return SnapshotNode(self.view, mid + 1, self.hi, self.depth + 1) if mid + 1 < self.hi else None
+
+    @property
+    def parent(self):
+        if not self.depth:
+            return None
+        return self.view._path_to(self.index)[-2]
+
+    def __eq__(self, other):
+        return isinstance(other, SnapshotNode) and self.view is other.view and \
+            self.lo == other.lo and self.hi == other.hi
+
+    def __hash__(self):
+        return hash((id(self.view), self.lo, self.hi))
+
+
+class SnapshotView:
+    """
+    A read-only RBTree-compatible view of a snapshot file.
+    The keys are searched where they lie in the mapped file, so opening is O(1)
+    and processes that open the same file share its pages.
+    Supports lookups, get_path, get_min/get_max, iteration, ranges and order statistics
+    """
+
+    def __init__(self, path):
+        if sys.byteorder == 'big':
+            raise SnapshotError("snapshots can only be mapped on little-endian machines")
+
+        with open(path, 'rb') as f:
+            count = read_header(f)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = HEADER.size + count * 8
+        if len(self._map) < end:
+            self._map.close()
+            raise SnapshotError("truncated keys")
+
+        self._keys = memoryview(self._map)[HEADER.size:end].cast('q')
+        self._red_depth = count.bit_length() - 1
+
+    def close(self):
+        self._keys.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def root(self):
+        return SnapshotNode(self, 0, len(self._keys), 0) if len(self._keys) else None
+
+    def _path_to(self, index):
+        """Returns the nodes from the root down to the node of a key index"""
+
+        path = []
+        lo, hi = 0, len(self._keys)
+        while lo < hi:
+            path.append(SnapshotNode(self, lo, hi, len(path)))
+            mid = (lo + hi) // 2
+            if index < mid:
+                hi = mid
+            elif index > mid:
+                lo = mid + 1
+            else:
+                return path
+        raise IndexError("snapshot index out of range")
+
+    def _find(self, key):
+        """Returns the index of key or -1"""
+
+        keys = self._keys
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            return index
+        return -1
+
+    def get_node(self, key):
+        """Returns a node by key"""
+
+        index = self._find(key)
+        return self._path_to(index)[-1] if index >= 0 else None
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def get(self, key, default=None):
+        """Returns a node by key or default if there is no such key"""
+
+        node = self.get_node(key)
+        return default if node is None else node
+
+    def get_path(self, node):
+        """Returns a path-list of keys from root to taken node"""
+
+        keys = self._keys
+        return iter([keys[step.index] for step in self._path_to(node.index)])
+
+    def get_min(self):
+        return self._path_to(0)[-1] if len(self._keys) else None
+
+    def get_max(self):
+        return self._path_to(len(self._keys) - 1)[-1] if len(self._keys) else None
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __reversed__(self):
+        return reversed(self._keys)
+
+    def irange(self, lo=None, hi=None, inclusive=(True, True)):
+        """Iterates over the keys between lo and hi in ascending order, like RBTree.irange"""
+
+        keys = self._keys
+        start = 0
+        stop = len(keys)
+        if lo is not None:
+            start = (bisect.bisect_left if inclusive[0] else bisect.bisect_right)(keys, lo)
+        if hi is not None:
+            stop = (bisect.bisect_right if inclusive[1] else bisect.bisect_left)(keys, hi)
+        # index instead of slicing: a live slice of the mapped keys would make close() fail
+        return map(keys.__getitem__, range(start, stop))
+
+    def rank(self, key):
+        """Returns the number of keys less than key"""
+
+        return bisect.bisect_left(self._keys, key)
+
+    def select(self, index):
+        """Returns the key with the given index in ascending order"""
+
+        return self._keys[index]
+
+    def count_range(self, lo, hi):
+        """Returns the number of keys k with lo <= k <= hi"""
+
+        if hi < lo:
+            return 0
+        return bisect.bisect_right(self._keys, hi) - bisect.bisect_left(self._keys, lo)
@@ -0,0 +1,107 @@
+"""
+Randomized regression tests for ArrayRBTree: every mutation is mirrored on a set and
+the tree is checked through its node handles after each step. Run with python -m unittest or pytest
+"""
+import random
+import unittest
+
+from arraytree import ArrayRBTree
+from rbtree import BLACK
+
+TRIALS = 200
+STEPS = 60
+KEY_RANGE = 200
+
+
+def _keys_and_black_height(node, lo=None, hi=None):
+    """Checks the subtree of node, returns its keys in order and its black height"""
+
+    if node is None:
+        return [], 1
+    key = node.key
+    assert (lo is None or lo < key) and (hi is None or key < hi), "keys out of order"
+    for child in (node.left, node.right):
+        if child is not None:
+            assert child.parent == node, "broken parent link"
+            assert node.color == BLACK or child.color == BLACK, "red node with a red child"
+    left, left_bh = _keys_and_black_height(node.left, lo, key)
+    right, right_bh = _keys_and_black_height(node.right, key, hi)
+    assert left_bh == right_bh, "black heights differ"
+    return left + [key] + right, left_bh + (node.color == BLACK)
+
+
+class FuzzTest(unittest.TestCase):
+
+    def check(self, tree, model):
+        root = tree.root
+        if root is not None:
+            self.assertIsNone(root.parent)
+            self.assertEqual(root.color, BLACK)
+        keys, _ = _keys_and_black_height(root)
+        self.assertEqual(keys, sorted(model))
+        self.assertEqual(tree.get_min().key if model else None, min(model, default=None))
+        self.assertEqual(tree.get_max().key if model else None, max(model, default=None))
+
+    def test_random_operations(self):
+        for trial in range(TRIALS):
+            rng = random.Random(trial)
+            model = set(rng.randrange(KEY_RANGE) for _ in range(rng.randrange(40)))
+            tree = ArrayRBTree(model)
+            self.check(tree, model)
+            for _ in range(STEPS):
+                key = rng.randrange(KEY_RANGE)
+                if rng.random() < 0.5:
+                    self.assertEqual(tree.insert(key), key not in model)
+                    model.add(key)
+                else:
+                    if model and rng.random() < 0.7:
+                        key = rng.choice(sorted(model))
+                    self.assertEqual(tree.delete(key), key in model)
+                    model.discard(key)
+                self.check(tree, model)
+                # every key has its own slot, freed slots stay in the arrays
+                self.assertLessEqual(len(model), len(tree._keys))
+
+    def test_lookups(self):
+        rng = random.Random(0)
+        model = set(rng.sample(range(-10 ** 12, 10 ** 12), 500))
+        tree = ArrayRBTree(model)
+        for key in sorted(model):
+            node = tree.get_node(key)
+            self.assertEqual(node.key, key)
+            self.assertIn(key, tree)
+            self.assertEqual(tree.get(key), node)
+            path = list(tree.get_path(node))
+            self.assertEqual(path[0], tree.root.key)
+            self.assertEqual(path[-1], key)
+            self.assertEqual(tree.get_node(key, tree.root), node)
+        for key in rng.sample(range(-10 ** 12, 10 ** 12), 100):
+            if key not in model:
+                self.assertIsNone(tree.get_node(key))
+                self.assertEqual(tree.get(key, 'missing'), 'missing')
+        self.assertLessEqual(tree.get_height(), 2 * (len(model) + 1).bit_length())
+
+    def test_free_list(self):
+        rng = random.Random(1)
+        keys = list(range(300))
+        tree = ArrayRBTree()
+        for key in rng.sample(keys, len(keys)):
+            tree.insert(key)
+        deleted = rng.sample(keys, 200)
+        for key in deleted:
+            self.assertTrue(tree.delete(key))
+        for key in range(1000, 1200):
+            self.assertTrue(tree.insert(key))
+        # the new keys took the slots of the deleted ones
+        self.assertEqual(len(tree._keys), len(keys))
+        self.check(tree, set(keys).difference(deleted).union(range(1000, 1200)))
+
+    def test_only_int_keys(self):
+        tree = ArrayRBTree([1, 2])
+        with self.assertRaises(TypeError):
+            tree.insert(1.5)
+        self.check(tree, {1, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Randomized regression tests for RBTree: every mutation is mirrored on a set
+and the tree is validated after each step. Run with python -m unittest or pytest
+"""
+import random
+import unittest
+
+from rbtree import RBTree
+
+TRIALS = 300
+STEPS = 40
+KEY_RANGE = 200
+
+
+def _random_keys(rng, count):
+    return [rng.randrange(KEY_RANGE) for _ in range(count)]
+
+
+class FuzzTest(unittest.TestCase):
+
+    def check(self, tree, model):
+        tree.validate()
+        self.assertEqual(list(tree), sorted(model))
+        self.assertEqual(len(tree), len(model))
+
+    def step(self, rng, tree, model):
+        """Applies one random operation to tree and model, returns the tree to continue with"""
+
+        op = rng.randrange(9)
+        if op == 0:
+            key = rng.randrange(KEY_RANGE)
+            self.assertEqual(tree.insert(key), key not in model)
+            model.add(key)
+        elif op == 1:
+            key = rng.choice(sorted(model)) if model and rng.random() < 0.7 else rng.randrange(KEY_RANGE)
+            self.assertEqual(tree.delete(key), key in model)
+            model.discard(key)
+        elif op == 2:
+            keys = _random_keys(rng, rng.randrange(1 + len(model) // 2 + 20))
+            self.assertEqual(tree.insert_many(keys), len(set(keys) - model))
+            model.update(keys)
+        elif op == 3:
+            keys = _random_keys(rng, rng.randrange(1 + len(model) + 5))
+            self.assertEqual(tree.delete_many(keys), len(set(keys) & model))
+            model.difference_update(keys)
+        elif op == 4:
+            key = rng.randrange(KEY_RANGE)
+            left, found, right = tree.split(key)
+            self.assertEqual(found is not None, key in model)
+            if found is not None:
+                self.assertEqual(found.key, key)
+            self.assertEqual(len(tree), 0)
+            left.validate()
+            right.validate()
+            self.assertEqual(list(left), sorted(k for k in model if k < key))
+            self.assertEqual(list(right), sorted(k for k in model if k > key))
+            tree = RBTree.join(left, key, right)
+            model.add(key)
+        elif op == 5:
+            other = _random_keys(rng, rng.randrange(60))
+            tree |= RBTree(other)
+            model.update(other)
+        elif op == 6:
+            other = _random_keys(rng, rng.randrange(150))
+            tree &= RBTree(other)
+            model.intersection_update(other)
+        elif op == 7:
+            other = _random_keys(rng, rng.randrange(60))
+            tree -= RBTree(other)
+            model.difference_update(other)
+        else:
+            other = RBTree(_random_keys(rng, rng.randrange(60)))
+            for result, expected in ((tree.union(other), model | set(other)),
+                                     (tree.intersection(other), model & set(other)),
+                                     (tree.difference(other), model - set(other))):
+                self.check(result, expected)
+        return tree
+
+    def test_random_operations(self):
+        for trial in range(TRIALS):
+            rng = random.Random(trial)
+            model = set(_random_keys(rng, rng.randrange(40)))
+            tree = RBTree(model)
+            for _ in range(STEPS):
+                tree = self.step(rng, tree, model)
+                self.check(tree, model)
+
+    def test_small_batches(self):
+        # batches too small for a rebuild, dense ones take the finger walk of insert_many
+        for trial in range(100):
+            rng = random.Random(trial)
+            model = set(rng.sample(range(5000), rng.randrange(100, 2000)))
+            tree = RBTree(model)
+            for _ in range(5):
+                lo = rng.randrange(5000)
+                keys = [rng.randrange(lo, lo + rng.randrange(1, 400)) for _ in range(rng.randrange(1, 20))]
+                self.assertEqual(tree.insert_many(keys), len(set(keys) - model))
+                model.update(keys)
+                self.check(tree, model)
+                keys = [rng.randrange(-100, 5100) for _ in range(rng.randrange(1, 20))]
+                self.assertEqual(tree.delete_many(keys), len(set(keys) & model))
+                model.difference_update(keys)
+                self.check(tree, model)
+
+    def test_key_function(self):
+        # the tree keeps the keys as passed in and orders them by key(k), the model maps key(k) to them
+        for trial in range(50):
+            rng = random.Random(trial)
+            words = [rng.choice('aAbBcCdD') + str(rng.randrange(30)) for _ in range(60)]
+            model = {}
+            for word in words[:20]:
+                model.setdefault(word.lower(), word)
+            tree = RBTree(words[:20], key=str.lower)
+            for word in words[20:]:
+                if rng.random() < 0.6:
+                    self.assertEqual(tree.insert(word), word.lower() not in model)
+                    model.setdefault(word.lower(), word)
+                else:
+                    self.assertEqual(tree.delete(word.upper()), word.lower() in model)
+                    model.pop(word.lower(), None)
+                tree.validate()
+                self.assertEqual(list(tree), [model[k] for k in sorted(model)])
+            self.assertEqual(list(tree.copy()), list(tree))
+            if model:
+                # the split node keeps the key as passed in and its value
+                key = rng.choice(sorted(model))
+                tree[model[key].upper()] = key
+                left, found, right = tree.split(key)
+                self.assertEqual((found.item, found.value), (model[key], key))
+                tree = RBTree.join(left, found.item, right, found.value)
+                tree.validate()
+                self.assertEqual(list(tree.items()), [(model[k], key if k == key else None) for k in sorted(model)])
+
+    def test_delete_every_key(self):
+        for trial in range(20):
+            rng = random.Random(trial)
+            keys = list(range(200))
+            tree = RBTree()
+            for key in rng.sample(keys, len(keys)):
+                tree.insert(key)
+            for key in rng.sample(keys, len(keys)):
+                self.assertTrue(tree.delete(key))
+                tree.validate()
+            self.assertIsNone(tree.root)
+
+
+if __name__ == '__main__':
+    unittest.main()
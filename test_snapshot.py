@@ -0,0 +1,115 @@
+"""
+Randomized regression tests for .rbtree snapshots: dump/load round trips and
+SnapshotView against the tree load builds from the same file. Run with python -m unittest or pytest
+"""
+import io
+import os
+import random
+import tempfile
+import unittest
+
+import snapshot
+from rbtree import RBTree
+
+TRIALS = 50
+INT64_MIN, INT64_MAX = -1 << 63, (1 << 63) - 1
+
+
+def _random_keys(rng, count):
+    keys = [rng.randrange(-10 ** 15, 10 ** 15) for _ in range(count)]
+    if rng.random() < 0.3:
+        keys += [INT64_MIN, INT64_MAX]
+    return keys
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'tree.rbtree')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_round_trip(self):
+        for trial in range(TRIALS):
+            rng = random.Random(trial)
+            tree = RBTree(_random_keys(rng, rng.randrange(3000)))
+            f = io.BytesIO()
+            snapshot.dump(tree, f)
+            self.assertEqual(len(f.getvalue()), snapshot.HEADER.size + 8 * len(tree))
+            f.seek(0)
+            loaded = snapshot.load(f)
+            loaded.validate()
+            self.assertEqual(list(loaded), list(tree))
+
+            snapshot.dump(tree, self.path)
+            self.assertEqual(list(snapshot.load(self.path)), list(tree))
+
+    def test_chunks(self):
+        tree = RBTree(range(-snapshot.CHUNK, 2 * snapshot.CHUNK + 5))
+        snapshot.dump(tree, self.path)
+        loaded = snapshot.load(self.path)
+        loaded.validate()
+        self.assertEqual(list(loaded), list(tree))
+
+    def test_failed_dump_keeps_the_old_file(self):
+        snapshot.dump(RBTree([1, 2, 3]), self.path)
+        for tree in (RBTree([1, 1 << 63]), RBTree([1.5]), RBTree({1: 'value'}.items())):
+            with self.assertRaises(snapshot.SnapshotError):
+                snapshot.dump(tree, self.path)
+        tree = RBTree()
+        tree[1] = 'value'
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.dump(tree, self.path)
+        self.assertEqual(list(snapshot.load(self.path)), [1, 2, 3])
+        self.assertEqual(os.listdir(self._dir.name), ['tree.rbtree'])
+
+    def test_bad_files(self):
+        snapshot.dump(RBTree(range(100)), self.path)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for bad in (b'', data[:10], b'X' + data[1:], data[:-8], data[:40] + data[48:56] + data[40:48] + data[56:]):
+            with self.assertRaises(snapshot.SnapshotError):
+                snapshot.load(io.BytesIO(bad))
+
+    def test_view_matches_load(self):
+        for trial in range(TRIALS):
+            rng = random.Random(trial)
+            keys = sorted(set(_random_keys(rng, rng.randrange(1, 1000))))
+            snapshot.dump(RBTree(keys), self.path)
+            loaded = snapshot.load(self.path)
+            with snapshot.SnapshotView(self.path) as view:
+                self.assertEqual(len(view), len(loaded))
+                self.assertEqual(list(view), keys)
+                self.assertEqual(list(reversed(view)), keys[::-1])
+                self.assertEqual(view.root.key, loaded.root.key)
+                self.assertEqual(view.get_min().key, keys[0])
+                self.assertEqual(view.get_max().key, keys[-1])
+                for key in rng.sample(keys, min(len(keys), 100)):
+                    node = view.get_node(key)
+                    expected = loaded.get_node(key)
+                    self.assertEqual(list(view.get_path(node)), list(loaded.get_path(expected)))
+                    self.assertEqual(node.color, expected.color)
+                    self.assertEqual(node.size, expected.size)
+                    self.assertEqual(view.get(key), node)
+                    self.assertIn(key, view)
+                    self.assertEqual(view.rank(key), loaded.rank(key))
+                    self.assertEqual(view.select(view.rank(key)), key)
+                for _ in range(20):
+                    key = rng.randrange(-10 ** 15, 10 ** 15)
+                    if key not in keys:
+                        self.assertIsNone(view.get_node(key))
+                        self.assertEqual(view.get(key, 'missing'), 'missing')
+                    lo, hi = sorted((key, rng.randrange(-10 ** 15, 10 ** 15)))
+                    self.assertEqual(list(view.irange(lo, hi)), list(loaded.irange(lo, hi)))
+                    self.assertEqual(list(view.irange(lo, hi, (False, False))),
+                                     list(loaded.irange(lo, hi, (False, False))))
+                    self.assertEqual(view.count_range(lo, hi), loaded.count_range(lo, hi))
+                # closing works while an irange is still alive
+                keys_left = view.irange(keys[0])
+            self.assertRaises(ValueError, list, keys_left)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+Randomized regression tests for wal.Store: every mutation of the stored tree is mirrored
+on a set and the directory is reopened to check what was persisted.
+Run with python -m unittest or pytest
+"""
+import os
+import random
+import tempfile
+import unittest
+
+import wal
+from rbtree import RBTree
+
+TRIALS = 30
+STEPS = 40
+KEY_RANGE = 500
+
+
+def _random_keys(rng, count):
+    return [rng.randrange(KEY_RANGE) for _ in range(count)]
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.directory = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def check(self, tree, model):
+        tree.validate()
+        self.assertEqual(list(tree), sorted(model))
+
+    def step(self, rng, tree, model):
+        """Applies one random logged operation to tree and model"""
+
+        op = rng.randrange(6)
+        if op == 0:
+            key = rng.randrange(KEY_RANGE)
+            tree.insert(key)
+            model.add(key)
+        elif op == 1:
+            key = rng.randrange(KEY_RANGE)
+            tree.delete(key)
+            model.discard(key)
+        elif op == 2:
+            keys = _random_keys(rng, rng.randrange(1 + len(model) // 2 + 20))
+            tree.insert_many(keys)
+            model.update(keys)
+        elif op == 3:
+            keys = _random_keys(rng, rng.randrange(1 + len(model) + 5))
+            tree.delete_many(keys)
+            model.difference_update(keys)
+        elif op == 4:
+            other = _random_keys(rng, rng.randrange(KEY_RANGE))
+            tree &= RBTree(other)
+            model.intersection_update(other)
+        else:
+            other = _random_keys(rng, rng.randrange(60))
+            tree |= RBTree(other)
+            model.update(other)
+
+    def test_replay(self):
+        for trial in range(TRIALS):
+            rng = random.Random(trial)
+            directory = os.path.join(self.directory, str(trial))
+            model = set()
+            for _ in range(3):
+                with wal.Store(directory) as store:
+                    self.check(store.tree, model)
+                    for _ in range(STEPS):
+                        self.step(rng, store.tree, model)
+            with wal.Store(directory) as store:
+                self.check(store.tree, model)
+                self.assertGreater(store.replayed, 0)
+
+    def test_reopen_without_close(self):
+        rng = random.Random(0)
+        model = set()
+        store = wal.Store(self.directory)
+        for _ in range(STEPS):
+            self.step(rng, store.tree, model)
+        store.flush()
+        # as after a crash: the first store is never closed
+        with wal.Store(self.directory) as reopened:
+            self.check(reopened.tree, model)
+        store.close()
+
+    def test_torn_tail(self):
+        for trial in range(TRIALS):
+            rng = random.Random(trial)
+            directory = os.path.join(self.directory, str(trial))
+            model = set(_random_keys(rng, 50))
+            with wal.Store(directory) as store:
+                store.tree.insert_many(model)
+            intact = os.path.getsize(os.path.join(directory, wal.LOG_NAME))
+
+            with wal.Store(directory) as store:
+                store.tree.insert_many(_random_keys(rng, 20))
+            # cut into the last record, anywhere but its end
+            log_path = os.path.join(directory, wal.LOG_NAME)
+            with open(log_path, 'r+b') as f:
+                f.truncate(rng.randrange(intact, os.path.getsize(log_path)))
+
+            with wal.Store(directory) as store:
+                self.check(store.tree, model)
+                self.assertEqual(os.path.getsize(log_path), intact)
+                key = rng.choice(sorted(model))
+                store.tree.delete(key)
+                model.discard(key)
+            with wal.Store(directory) as store:
+                self.check(store.tree, model)
+
+    def test_checkpoint(self):
+        rng = random.Random(0)
+        model = set()
+        with wal.Store(self.directory) as store:
+            for _ in range(STEPS):
+                self.step(rng, store.tree, model)
+            store.checkpoint()
+            self.assertEqual(store.log_size, 0)
+            for _ in range(STEPS):
+                self.step(rng, store.tree, model)
+        with wal.Store(self.directory) as store:
+            self.check(store.tree, model)
+        self.assertEqual(sorted(os.listdir(self.directory)), [wal.SNAPSHOT_NAME, wal.LOG_NAME])
+
+    def test_compaction(self):
+        rng = random.Random(1)
+        model = set()
+        with wal.Store(self.directory, compact_bytes=1024) as store:
+            for _ in range(STEPS):
+                self.step(rng, store.tree, model)
+                self.assertLess(store.log_size, 1024)
+        with wal.Store(self.directory) as store:
+            self.check(store.tree, model)
+            self.assertTrue(os.path.exists(store.snapshot_path))
+
+    def test_rejected_changes(self):
+        with wal.Store(self.directory) as store:
+            tree = store.tree
+            tree.insert_many(range(10))
+            size = store.log_size
+            # the record is packed before the tree changes, so nothing is applied or logged
+            for change in (lambda: tree.insert(1 << 63), lambda: tree.insert_many([20, -1 << 64]),
+                           lambda: tree.insert(30, 'value'), lambda: tree.__setitem__(5, 'value')):
+                self.assertRaises(ValueError, change)
+                self.check(tree, range(10))
+                self.assertEqual(store.log_size, size)
+            self.assertIsNone(tree[5])
+        with wal.Store(self.directory) as store:
+            self.check(store.tree, range(10))
+
+    def test_read_log(self):
+        with wal.Store(self.directory) as store:
+            store.tree.insert(3)
+            store.tree.insert_many([5, 1, 5])
+            store.tree.delete(3)
+            store.tree.delete(42)
+        log_path = os.path.join(self.directory, wal.LOG_NAME)
+        self.assertEqual([(op, list(keys)) for op, keys in wal.read_log(log_path)],
+                         [('insert', [3]), ('insert', [1, 5]), ('delete', [3])])
+        self.assertEqual(wal.valid_length(log_path), os.path.getsize(log_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+Incremental persistence for RBTree: a snapshot plus a write-ahead log.
+
+Every mutation of the tree appends one record to the log, so saving costs
+O(changes) instead of O(n). The record is packed before the tree changes:
+keys the log can't hold fail the mutation and leave the tree as it was. When the log grows past a limit it is compacted:
+the tree is written to a new snapshot and the log starts over.
+On open the snapshot is loaded and the log is replayed on top of it.
+
+Record, little-endian: op (1 byte), key count (4 bytes), int64 keys, crc32 of the rest.
+Like snapshots, the log only holds int keys that fit into int64 and no values:
+mapping a key to anything but None raises ValueError.
+A torn record at the end of the log, left by a crash, is dropped on replay.
+Replaying a log onto a tree that already contains its changes is harmless,
+so a crash between writing a snapshot and truncating the log loses nothing
+"""
+import array
+import os
+import struct
+import sys
+import zlib
+
+import snapshot
+from rbtree import RBTree
+
+OPS = {'insert': 1, 'delete': 2, 'retain': 3, 'clear': 4}
+OP_NAMES = {code: name for name, code in OPS.items()}
+
+RECORD_HEADER = struct.Struct('<BI')
+RECORD_CRC = struct.Struct('<I')
+
+SNAPSHOT_NAME = 'tree.rbtree'
+LOG_NAME = 'tree.wal'
+
+
+def _pack_keys(keys):
+    try:
+        packed = array.array('q', keys)
+    except (TypeError, OverflowError):
+        raise ValueError("the log only holds int64 keys")
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def read_log(path):
+    """
+    Yields (op, keys) for every intact record of the log at path.
+    Stops at the first torn or corrupt record, see valid_length
+    """
+
+    for op, keys, _ in _scan(path):
+        yield op, keys
+
+
+def valid_length(path):
+    """Returns the length of the intact prefix of the log at path"""
+
+    end = 0
+    for _, _, end in _scan(path):
+        pass
+    return end
+
+
+def _scan(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            code, count = RECORD_HEADER.unpack(header)
+            body = f.read(count * 8)
+            crc = f.read(RECORD_CRC.size)
+            if code not in OP_NAMES or len(body) < count * 8 or len(crc) < RECORD_CRC.size or \
+                    RECORD_CRC.unpack(crc)[0] != zlib.crc32(header + body):
+                return
+            keys = array.array('q')
+            keys.frombytes(body)
+            if sys.byteorder == 'big':
+                keys.byteswap()
+            offset += RECORD_HEADER.size + len(body) + RECORD_CRC.size
+            yield OP_NAMES[code], keys, offset
+
+
+def apply(tree, op, keys):
+    """Applies one logged operation to tree"""
+
+    if op == 'insert':
+        tree.insert_many(keys)
+    elif op == 'delete':
+        tree.delete_many(keys)
+    elif op == 'retain':
+        tree &= type(tree)(keys)
+    elif op == 'clear':
+        tree.root = None
+
+
+class Store:
+    """
+    A tree persisted in a directory as a snapshot and a write-ahead log.
+    Mutations of store.tree are logged as they happen. flush() makes them durable,
+    checkpoint() compacts the log into a new snapshot, which also happens by itself
+    once the log is larger than compact_bytes. With sync=True every record is fsynced
+    """
+
+    def __init__(self, directory, cls=RBTree, sync=False, compact_bytes=64 << 20):
+        self.directory = directory
+        self.sync = sync
+        self.compact_bytes = compact_bytes
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+        self.log_path = os.path.join(directory, LOG_NAME)
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.exists(self.snapshot_path):
+            self.tree = snapshot.load(self.snapshot_path, cls)
+        else:
+            self.tree = cls()
+
+        self.replayed = 0
+        for op, keys in read_log(self.log_path):
+            apply(self.tree, op, keys)
+            self.replayed += 1
+
+        self._file = open(self.log_path, 'ab')
+        # cut off a torn record so new records are not appended after it
+        self._file.truncate(valid_length(self.log_path))
+        self._file.seek(0, os.SEEK_END)
+        self.tree._log = self
+
+    @property
+    def log_size(self):
+        return self._file.tell()
+
+    def pack(self, op, keys, values=()):
+        """
+        Packs one operation into a record. Called by the tree before it changes,
+        raises ValueError if the log can't hold the keys or the values they are mapped to
+        """
+
+        if any(value is not None for value in values):
+            raise ValueError("the log doesn't hold values")
+        header = RECORD_HEADER.pack(OPS[op], len(keys))
+        body = _pack_keys(keys)
+        return header + body + RECORD_CRC.pack(zlib.crc32(header + body))
+
+    def write(self, record):
+        """Appends a packed record to the log. Called by the tree once the change is applied"""
+
+        self._file.write(record)
+        if self.sync:
+            self.flush()
+        if self._file.tell() >= self.compact_bytes:
+            self.checkpoint()
+
+    def flush(self):
+        """Makes every logged mutation durable"""
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def checkpoint(self):
+        """Writes the tree to a new snapshot and empties the log"""
+
+        self._file.flush()
+        snapshot.dump(self.tree, self.snapshot_path)
+
+        self._file.truncate(0)
+        self._file.seek(0)
+        self.flush()
+
+    def close(self):
+        if self.tree._log is self:
+            del self.tree._log
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()